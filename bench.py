@@ -0,0 +1,423 @@
+import os
+import io
+import sys
+import time
+import json
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import importlib.util
+import requests
+from contextlib import redirect_stdout
+from ccmz import LibCCMZ
+import smf
+import transport
+import ratelimit
+from bench_fixtures import make_v2_blob, make_midi_json, make_v1_score, make_v2_score
+from bench_server import StandInServer
+from bench_legacy import legacy_decode_v2, legacy_parse_midi_event, legacy_write_midi
+
+
+RESULTS = []
+
+
+def record(bench, name, line, **values):
+    """打印一行结果并记录下来, 供--json保存"""
+    print(line)
+    RESULTS.append({'bench': bench, 'name': name, **values})
+
+
+def timeit(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure_peak(func):
+    """返回(耗时, 内存峰值字节), tracemalloc会拖慢执行, 耗时只用于相对比较"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        func()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_decode(sizes, repeat):
+    engines = {
+        'legacy': legacy_decode_v2,
+        'translate': lambda d: LibCCMZ.decode_v2(d, engine='translate'),
+    }
+    try:
+        import numpy  # noqa: F401
+        engines['numpy'] = lambda d: LibCCMZ.decode_v2(d, engine='numpy')
+    except ImportError:
+        pass
+
+    for size in sizes:
+        blob = make_v2_blob(size)
+        data = memoryview(blob)[1:]
+        expected = legacy_decode_v2(data)
+        for name, func in engines.items():
+            if bytes(func(data)) != expected:
+                raise AssertionError(f"{name} 解码结果不一致")
+            elapsed = timeit(lambda: func(data), 1 if name == 'legacy' else repeat)
+            mb = size / (1 << 20)
+            record('decode_v2', name,
+                   f"decode_v2 {name:>9} {mb:6.1f}MB  {elapsed * 1000:9.2f}ms  {mb / elapsed:9.1f}MB/s",
+                   bytes=size, seconds=elapsed)
+
+
+def bench_read_ccmz(note_counts, repeat):
+    """v1和v2完整读取(read_ccmz)"""
+    def read(blob):
+        result = []
+        LibCCMZ.read_ccmz(blob, result.append)
+        return result[0]
+
+    for notes in note_counts:
+        for ver, make in ((1, make_v1_score), (2, make_v2_score)):
+            blob = make(notes)
+            elapsed = timeit(lambda: read(blob), repeat)
+            _, peak = measure_peak(lambda: read(blob))
+            record('read_ccmz', f'v{ver}',
+                   f"read_ccmz       v{ver} {len(blob) / (1 << 20):6.2f}MB  {elapsed * 1000:9.2f}ms"
+                   f"  峰值{peak / (1 << 20):8.1f}MB",
+                   notes=notes, bytes=len(blob), seconds=elapsed, peak=peak)
+
+
+def bench_container(note_counts, repeat):
+    def eager(blob):
+        result = []
+        LibCCMZ.read_ccmz(blob, result.append)
+        return json.loads(result[0].midi)
+
+    def lazy(blob):
+        return json.loads(LibCCMZ.open_ccmz(blob).raw('midi'))
+
+    for notes in note_counts:
+        blob = make_v2_score(notes)
+        for name, func in (('read_ccmz', eager), ('open_ccmz', lazy)):
+            elapsed = timeit(lambda: func(blob), repeat)
+            _, peak = measure_peak(lambda: func(blob))
+            record('midi_only', name,
+                   f"midi_only {name:>9} {len(blob) / (1 << 20):6.1f}MB  {elapsed * 1000:9.2f}ms"
+                   f"  峰值{peak / (1 << 20):8.1f}MB",
+                   notes=notes, bytes=len(blob), seconds=elapsed, peak=peak)
+
+
+def bench_events(note_counts, repeat):
+    def legacy(events):
+        parsed = []
+        for event in events:
+            parsed_event = legacy_parse_midi_event(event.get('event', []))
+            if parsed_event:
+                parsed_event['tick'] = event['tick']
+                parsed_event['duration'] = event.get('duration', 0)
+                parsed_event['staff'] = event.get('staff', 0)
+                parsed_event['track'] = event.get('track', 0)
+                parsed.append(parsed_event)
+        return parsed
+
+    def compact(events):
+        parsed = []
+        decode = LibCCMZ.decode_event
+        for event in events:
+            parsed_event = decode(event.get('event'), event['tick'], event.get('track', 0),
+                                  event.get('duration', 0), event.get('staff', 0))
+            if parsed_event is not None:
+                parsed.append(parsed_event)
+        return parsed
+
+    def current(events):
+        parse = LibCCMZ.parse_midi_event
+        return [parse(event.get('event')) for event in events]
+
+    for notes in note_counts:
+        events = make_midi_json(notes)['events']
+        for name, func in (('dict', legacy), ('slots', compact), ('parse', current)):
+            elapsed = timeit(lambda: func(events), repeat)
+            _, peak = measure_peak(lambda: func(events))
+            record('parse_events', name,
+                   f"parse_events {name:>5} {len(events):8d}事件  {elapsed * 1000:9.2f}ms"
+                   f"  峰值{peak / (1 << 20):8.1f}MB",
+                   events=len(events), seconds=elapsed, peak=peak)
+
+
+def bench_midi(note_counts, repeat):
+    writers = {'smf': LibCCMZ.write_midi}
+    if importlib.util.find_spec('midiutil'):
+        writers['midiutil'] = legacy_write_midi
+    else:
+        print("未安装midiutil, 跳过旧实现对比")
+
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_tmp.mid')
+    try:
+        for notes in note_counts:
+            data = make_midi_json(notes)
+            for name, func in writers.items():
+                elapsed = timeit(lambda: func(data, path), repeat)
+                _, peak = measure_peak(lambda: func(data, path))
+                size = os.path.getsize(path)
+                record('write_midi', name,
+                       f"write_midi {name:>8} {len(data['events']):8d}事件  {elapsed * 1000:9.2f}ms"
+                       f"  峰值{peak / (1 << 20):8.1f}MB  {size:9d}B",
+                       events=len(data['events']), seconds=elapsed, peak=peak, bytes=size)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def bench_notes(note_counts, repeat):
+    """配对音符: pair_notes逐个事件处理 与 note_arrays数组运算"""
+    if not importlib.util.find_spec('numpy'):
+        print("未安装numpy, 跳过note_arrays")
+        return
+
+    def loop(data):
+        tracks = len(data['tracks'])
+        return list(LibCCMZ.pair_notes(LibCCMZ.iter_track_events(data['events'], tracks)))
+
+    for notes in note_counts:
+        data = make_midi_json(notes)
+        for name, func in (('pair_notes', loop), ('note_arrays', LibCCMZ.note_arrays)):
+            elapsed = timeit(lambda: func(data), repeat)
+            _, peak = measure_peak(lambda: func(data))
+            record('notes', name,
+                   f"notes {name:>11} {len(data['events']):8d}事件  {elapsed * 1000:9.2f}ms"
+                   f"  峰值{peak / (1 << 20):8.1f}MB",
+                   events=len(data['events']), seconds=elapsed, peak=peak)
+
+
+def check_roundtrip(notes=2000):
+    """写出 -> 解析 -> 按解析结果重写, 两次字节必须一致, 音符与输入一致"""
+    data = make_midi_json(notes)
+    buf = io.BytesIO()
+    LibCCMZ.write_midi(data, buf)
+    first = buf.getvalue()
+
+    division, tracks = smf.read_tracks(first)
+    writer = smf.SMFWriter(len(tracks) - 1, division)
+    for idx, events in enumerate(tracks):
+        for tick, event in events:
+            if event != smf.END_OF_TRACK[1:]:
+                writer.add_event(idx, tick, event)
+    second = writer.to_bytes()
+    if first != second:
+        raise AssertionError("SMF往返后字节不一致")
+
+    # 每个noteOn都应该写出一个音符, 包括同音高重叠的音符
+    expected = sorted((e['track'], e['event'][1], e['tick'])
+                      for e in data['events'] if e['event'][0] == 0x90)
+    written = sorted((idx - 1, event[1], tick) for idx, events in enumerate(tracks)
+                     for tick, event in events if event[0] & 0xF0 == 0x90)
+    if expected != written:
+        raise AssertionError("SMF往返后音符不一致")
+
+    record('roundtrip', 'smf', f"roundtrip ok: {len(first)}B, {len(written)}个音符",
+           bytes=len(first), notes=len(written))
+
+
+def check_transport():
+    """对本地模拟服务检查网络层: 503重试后成功、慢响应超时、连接复用"""
+    with StandInServer(validators=False) as server:
+        base = server.base_url
+        t = transport.Transport(timeout=(1, 0.3), retries=3, backoff=0.01, limiter=ratelimit.RateLimiter(0, 0))
+        try:
+            if t.fetch(f"{base}/flaky/a/2") != b'ok':
+                raise AssertionError("503重试后内容不对")
+            if t.stats()['retries'] != 2:
+                raise AssertionError(f"应重试2次, 实际{t.stats()['retries']}次")
+            before = server.requests
+            try:
+                t.fetch(f"{base}/flaky/b/10")
+            except requests.HTTPError as e:
+                if e.response.status_code != 503:
+                    raise
+            else:
+                raise AssertionError("重试用完后应返回503")
+            if server.requests - before != 4:
+                raise AssertionError(f"retries=3应发出4个请求, 实际{server.requests - before}个")
+
+            for _ in range(20):
+                t.fetch(f"{base}/slow/0")
+            hosts = t.stats()['hosts']
+            item = hosts[next(iter(hosts))]
+        finally:
+            t.close()
+
+        quick = transport.Transport(timeout=(1, 0.2), retries=0, limiter=ratelimit.RateLimiter(0, 0))
+        start = time.perf_counter()
+        try:
+            quick.fetch(f"{base}/slow/2000")
+        except (requests.Timeout, requests.ConnectionError):
+            pass
+        else:
+            raise AssertionError("慢响应应超时")
+        finally:
+            quick.close()
+        waited = time.perf_counter() - start
+        if waited > 1.5:
+            raise AssertionError(f"超时设置没有生效: 等了{waited:.2f}秒")
+
+    if item['connections'] > 2 or item['reused'] < item['requests'] - 2:
+        raise AssertionError(f"连接没有复用: {item}")
+    record('transport', 'checks', f"transport ok: {item['requests']}个请求用了{item['connections']}个连接, "
+           f"超时{waited:.2f}秒", requests=item['requests'], connections=item['connections'],
+           timeout_seconds=waited)
+
+
+def check_sync():
+    """启用缓存时增量同步: 没变化时跳过, 琴谱更新后(ccmz仍在缓存里)必须重新生成midi"""
+    import hashlib
+    import main as cli
+    import client
+
+    def run_main(argv):
+        saved, sys.argv = sys.argv, ['main.py', *argv]
+        try:
+            with redirect_stdout(io.StringIO()) as out:
+                cli.main()
+        finally:
+            sys.argv = saved
+        return out.getvalue()
+
+    def midi_digest(out_dir):
+        names = [n for n in os.listdir(out_dir) if n.endswith('.mid')]
+        if len(names) != 1:
+            raise AssertionError(f"应生成1个midi文件: {names}")
+        with open(os.path.join(out_dir, names[0]), 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    with StandInServer() as server, tempfile.TemporaryDirectory() as tmp:
+        client.SITE_URL = client.API_URL = server.base_url
+        for extra in ([], ['--stream']):
+            out_dir = tempfile.mkdtemp(dir=tmp)
+            argv = ['-i', '1', '-o', out_dir, '--cache-dir', tempfile.mkdtemp(dir=tmp), '--no-index',
+                    '--sync', *extra]
+            server.revisions.clear()
+            run_main(argv)
+            first = midi_digest(out_dir)
+            before = server.requests
+            if '未变化, 跳过' not in run_main(argv) or server.requests - before != 1:
+                raise AssertionError("没有变化时应只发一个条件请求并跳过")
+            server.update('1')
+            run_main(argv)
+            if midi_digest(out_dir) == first:
+                raise AssertionError(f"琴谱更新后midi没有重新生成 {extra}")
+    record('sync', 'checks', "sync ok: 缓存开启时琴谱更新后midi已重新生成")
+
+
+def bench_end_to_end(count, jobs, latency, pages, repeat, capacity=None):
+    """对本地模拟服务完整运行main(), 不使用缓存和索引
+
+    不限制每秒请求数, 测的是处理速度; capacity为模拟服务的并发上限, 超出返回429, 用于测试自适应并发。
+    """
+    import main as cli
+    import client
+
+    modes = [('midi', [])]
+    if importlib.util.find_spec('reportlab') and importlib.util.find_spec('PIL'):
+        modes.append(('pdf', ['-pdf']))
+    ids = [str(i) for i in range(1, count + 1)]
+    with StandInServer(latency=latency, pages=pages, capacity=capacity) as server, tempfile.TemporaryDirectory() as tmp:
+        client.SITE_URL = client.API_URL = server.base_url
+        for name, extra in modes:
+            requests = []
+
+            def run():
+                argv = ['main.py', '-i', *ids, '-o', tempfile.mkdtemp(dir=tmp), '--no-cache', '--no-index',
+                        '-j', str(jobs), '--rate', '0', *extra]
+                start, throttled = server.requests, server.throttled
+                saved, sys.argv = sys.argv, argv
+                try:
+                    with redirect_stdout(io.StringIO()):
+                        cli.main()
+                except SystemExit as e:
+                    if e.code:
+                        raise AssertionError(f"main()以{e.code}退出")
+                finally:
+                    sys.argv = saved
+                requests.append((server.requests - start, server.throttled - throttled))
+
+            elapsed = timeit(run, repeat)
+            record('end_to_end', name,
+                   f"end_to_end {name:>5} {count}个琴谱 延迟{latency * 1000:.0f}ms  {elapsed * 1000:9.2f}ms"
+                   f"  {count / elapsed:7.1f}个/秒  {requests[-1][0]}个请求  429共{requests[-1][1]}次",
+                   scores=count, jobs=jobs, latency=latency, pages=pages, capacity=capacity, seconds=elapsed,
+                   requests=requests[-1][0], throttled=requests[-1][1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def save_results(path, args):
+    data = {
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': vars(args),
+        'results': RESULTS,
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存: {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ccmz性能测试")
+    parser.add_argument('--only', default='decode,read,container,events,midi,notes,roundtrip,transport,sync,e2e',
+                        help='要运行的测试, 逗号分隔')
+    parser.add_argument('--sizes', default='1,4,16', help='解码测试文件大小(MB), 逗号分隔')
+    parser.add_argument('--notes', default='5000,50000', help='midi测试每轨音符数, 逗号分隔')
+    parser.add_argument('--repeat', type=int, default=5, help='重复次数, 取最优')
+    parser.add_argument('--scores', type=int, default=20, help='端到端测试的琴谱数')
+    parser.add_argument('--jobs', type=int, default=4, help='端到端测试的并发数')
+    parser.add_argument('--latency', type=float, default=0.02, help='模拟服务每个请求的延迟(秒)')
+    parser.add_argument('--pages', type=int, default=3, help='模拟服务每个琴谱的图片页数')
+    parser.add_argument('--capacity', type=int, help='模拟服务同时处理的请求数上限, 超出返回429')
+    parser.add_argument('--json', metavar='PATH', help='把结果保存为json, 便于比较不同提交')
+    args = parser.parse_args()
+
+    only = set(args.only.split(','))
+    if 'decode' in only:
+        sizes = [int(float(s) * (1 << 20)) for s in args.sizes.split(',')]
+        bench_decode(sizes, args.repeat)
+    if 'read' in only:
+        bench_read_ccmz([int(n) for n in args.notes.split(',')], args.repeat)
+    if 'container' in only:
+        bench_container([int(n) for n in args.notes.split(',')], args.repeat)
+    if 'events' in only:
+        bench_events([int(n) for n in args.notes.split(',')], args.repeat)
+    if 'midi' in only:
+        bench_midi([int(n) for n in args.notes.split(',')], args.repeat)
+    if 'notes' in only:
+        bench_notes([int(n) for n in args.notes.split(',')], args.repeat)
+    if 'roundtrip' in only:
+        check_roundtrip()
+    if 'transport' in only:
+        check_transport()
+    if 'sync' in only:
+        check_sync()
+    if 'e2e' in only:
+        bench_end_to_end(args.scores, args.jobs, args.latency, args.pages, min(args.repeat, 3), args.capacity)
+    if args.json:
+        save_results(args.json, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
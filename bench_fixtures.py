@@ -0,0 +1,134 @@
+import io
+import os
+import sys
+import json
+import zlib
+import struct
+import random
+import zipfile
+import argparse
+from ccmz import LibCCMZ
+
+
+def make_v2_blob(size):
+    # 不可压缩的随机内容, 保证解混淆的数据量接近size
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+        zf.writestr("score.json", os.urandom(size // 2))
+        zf.writestr("midi.json", os.urandom(size - size // 2))
+    return b'\x02' + LibCCMZ.decode_v2(buf.getvalue(), engine='translate')
+
+
+def make_midi_json(notes, tracks=2, seed=0):
+    """生成v2 midi.json结构, 每轨notes个音符, 带少量踏板和弯音"""
+    rnd = random.Random(seed)
+    events = []
+    for track in range(tracks):
+        tick = 0
+        for i in range(notes):
+            pitch = rnd.randint(36, 96)
+            length = rnd.choice((120, 240, 480, 960))
+            events.append({'tick': tick, 'track': track, 'staff': 1, 'duration': length,
+                           'event': [0x90, pitch, rnd.randint(30, 110)]})
+            events.append({'tick': tick + length, 'track': track, 'staff': 1,
+                           'event': [0x80, pitch, 0]})
+            if i % 16 == 0:
+                events.append({'tick': tick, 'track': track, 'event': [0xB0, 64, 127 if i % 32 else 0]})
+            if i % 64 == 0:
+                bend = rnd.randint(0, 16383)
+                events.append({'tick': tick, 'track': track, 'event': [0xE0, bend & 0x7F, bend >> 7]})
+            tick += rnd.choice((0, 0, 120, 240))
+    events.sort(key=lambda e: e['tick'])
+    tempos = [{'tick': i * 1920 * 8, 'tempo': rnd.randint(400000, 700000)} for i in range(4)]
+    return {'tempos': tempos,
+            'tracks': [{'name': f'Track{t}', 'program': 0} for t in range(tracks)],
+            'events': events}
+
+
+def make_v2_score(notes, seed=0):
+    """生成较真实的v2 ccmz: deflate压缩, score.json比midi.json大"""
+    rnd = random.Random(seed)
+    midi = make_midi_json(notes, seed=seed)
+    measures = [{'index': m, 'notes': [{'pitch': rnd.randint(36, 96), 'duration': rnd.choice((1, 2, 4, 8)),
+                                        'x': rnd.random() * 1000, 'y': rnd.random() * 200, 'staff': m % 2}
+                                       for _ in range(16)]}
+                for m in range(notes // 4)]
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("score.json", json.dumps({'measures': measures}))
+        zf.writestr("midi.json", json.dumps(midi))
+    return b'\x02' + LibCCMZ.decode_v2(buf.getvalue(), engine='translate')
+
+
+def make_v1_score(notes, seed=0):
+    """生成v1 ccmz: 不混淆的zip, data.xml为MusicXML, data.mid为标准MIDI文件"""
+    rnd = random.Random(seed)
+    midi = io.BytesIO()
+    LibCCMZ.write_midi(make_midi_json(notes, seed=seed), midi)
+    steps = 'CDEFGAB'
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<score-partwise version="3.1"><part id="P1">']
+    for m in range(notes // 4):
+        parts.append(f'<measure number="{m + 1}">')
+        for _ in range(4):
+            parts.append(f'<note><pitch><step>{rnd.choice(steps)}</step><octave>{rnd.randint(2, 6)}'
+                         f'</octave></pitch><duration>{rnd.choice((1, 2, 4))}</duration></note>')
+        parts.append('</measure>')
+    parts.append('</part></score-partwise>')
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("data.xml", ''.join(parts))
+        zf.writestr("data.mid", midi.getvalue())
+    return b'\x01' + buf.getvalue()
+
+
+def make_page_png(width=1240, height=1754, seed=0):
+    """生成一页灰度曲谱图片: 白底加五线谱横线, 不依赖PIL"""
+    rnd = random.Random(seed)
+    white = b'\x00' + b'\xff' * width
+    black = b'\x00' + b'\x00' * width
+    rows = []
+    for y in range(height):
+        # 每160像素一组五线谱, 线间距12像素
+        offset = y % 160 - 40
+        rows.append(black if 0 <= offset < 60 and offset % 12 == 0 else white)
+    # 随机加些音符黑块, 让各页内容不同
+    raw = bytearray(b''.join(rows))
+    for _ in range(height // 8):
+        x, y = rnd.randrange(1, width - 8), rnd.randrange(0, height - 8)
+        for dy in range(8):
+            pos = (y + dy) * (width + 1) + 1 + x
+            raw[pos:pos + 8] = b'\x00' * 8
+
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body))
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(bytes(raw), 6))
+            + chunk(b'IEND', b''))
+
+
+def write_fixtures(out_dir, note_counts):
+    """按音符数各写一个v1和v2 ccmz文件, 返回写出的路径"""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for notes in note_counts:
+        for ver, make in ((1, make_v1_score), (2, make_v2_score)):
+            path = os.path.join(out_dir, f"v{ver}_{notes}.ccmz")
+            with open(path, 'wb') as f:
+                f.write(make(notes))
+            paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成测试用的ccmz文件")
+    parser.add_argument('output', help='保存目录')
+    parser.add_argument('--notes', default='500,5000,50000', help='每轨音符数, 逗号分隔')
+    args = parser.parse_args()
+    for path in write_fixtures(args.output, [int(n) for n in args.notes.split(',')]):
+        print(f"{path}  {os.path.getsize(path)}B")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
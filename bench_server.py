@@ -0,0 +1,200 @@
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from bench_fixtures import make_v2_score, make_page_png
+
+
+class StandInServer:
+    """本地模拟gangqinpu的琴谱页面、详情接口、ccmz和曲谱图片
+
+    latency为每个请求的额外延迟(秒), 琴谱内容按id生成, 同一个id每次内容相同, 调用update()后改变。
+    validators为True时响应带ETag/Last-Modified, 并对条件请求返回304。
+    capacity为同时处理的请求数上限, 超出时返回429, 模拟服务器限流。
+    另有测试网络层用的地址: /flaky/<名字>/<n> 前n次返回503, 之后返回ok; /slow/<毫秒> 等待后返回ok。
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, pages=3, notes=500, validators=True,
+                 capacity=None):
+        self.latency = latency
+        self.capacity = capacity
+        self.in_flight = 0
+        self.throttled = 0
+        self.pages = pages
+        self.notes = notes
+        self.validators = validators
+        self.requests = 0
+        self.not_modified = 0
+        self.revisions = {}
+        self.attempts = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def update(self, music_id):
+        """模拟琴谱被修改: 详情和ccmz内容都会变"""
+        music_id = str(music_id)
+        self.revisions[music_id] = self.revisions.get(music_id, 0) + 1
+
+    def ccmz(self, music_id):
+        return self._ccmz(music_id, self.revisions.get(music_id, 0))
+
+    @lru_cache(maxsize=64)
+    def _ccmz(self, music_id, revision):
+        return make_v2_score(self.notes, seed=int(music_id) + revision * 100003)
+
+    @lru_cache(maxsize=64)
+    def page(self, music_id, page):
+        return make_page_png(seed=int(music_id) * 1000 + page)
+
+    def route(self, path):
+        """返回(状态码, Content-Type, 内容)"""
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        base = self.base_url
+        urlparam = query.get('urlparam', [''])[0]
+        if url.path.startswith('/flaky/'):
+            name, _, fails = url.path[len('/flaky/'):].rpartition('/')
+            with self._lock:
+                attempt = self.attempts[name] = self.attempts.get(name, 0) + 1
+            if attempt <= int(fails):
+                return 503, 'text/plain', b'unavailable'
+            return 200, 'text/plain', b'ok'
+        if url.path.startswith('/slow/'):
+            time.sleep(int(url.path[len('/slow/'):]) / 1000)
+            return 200, 'text/plain', b'ok'
+        if url.path.startswith('/cchtml/') and url.path.endswith('.htm'):
+            music_id = url.path[len('/cchtml/'):-len('.htm')]
+            html = f'<html><body><div class="opern" data-oid="{music_id}"></div></body></html>'
+            return 200, 'text/html; charset=utf-8', html.encode('utf-8')
+        if urlparam == 'pad/detail/operninfov002':
+            opern_id = query['old_id'][0]
+            details = {'list': {'name': f'测试曲{opern_id}', 'is_pay': '0', 'typename': '测试',
+                                'author': 'bench', 'play_json': f'{base}/ccmz/{opern_id}.ccmz',
+                                'revision': self.revisions.get(opern_id, 0)}}
+            return 200, 'application/json', json.dumps(details, ensure_ascii=False).encode('utf-8')
+        if urlparam == 'home/user/getOpernDetail':
+            music_id = query['id'][0]
+            images = [f'{base}/image/{music_id}-{i}.png' for i in range(self.pages)]
+            return 200, 'application/json', json.dumps({'returnMsg': 'ok', 'list': {'image_list': images}}).encode()
+        if url.path.startswith('/ccmz/') and url.path.endswith('.ccmz'):
+            return 200, 'application/octet-stream', self.ccmz(url.path[len('/ccmz/'):-len('.ccmz')])
+        if url.path.startswith('/image/') and url.path.endswith('.png'):
+            music_id, _, page = url.path[len('/image/'):-len('.png')].rpartition('-')
+            return 200, 'image/png', self.page(music_id, int(page))
+        return 404, 'text/plain', b'not found'
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                    busy = server.capacity is not None and server.in_flight >= server.capacity
+                    if busy:
+                        server.throttled += 1
+                    else:
+                        server.in_flight += 1
+                if busy:
+                    self.send_response(429)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                try:
+                    self.respond()
+                finally:
+                    with server._lock:
+                        server.in_flight -= 1
+
+            def respond(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                try:
+                    status, ctype, body = server.route(self.path)
+                except (KeyError, ValueError):
+                    status, ctype, body = 400, 'text/plain', b'bad request'
+                etag = None
+                if status == 200 and server.validators:
+                    etag = '"%s"' % hashlib.sha256(body).hexdigest()[:20]
+                    if self.headers.get('If-None-Match') == etag:
+                        with server._lock:
+                            server.not_modified += 1
+                        status, body = 304, b''
+                try:
+                    self.send(status, ctype, body, etag)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端已超时断开(/slow测试), 不算错误
+                    self.close_connection = True
+
+            def send(self, status, ctype, body, etag):
+                self.send_response(status)
+                if etag:
+                    self.send_header('ETag', etag)
+                    self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')
+                if status != 304:
+                    self.send_header('Content-Type', ctype)
+                    self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        try:
+            self._httpd.serve_forever()
+        finally:
+            self._httpd.server_close()
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟gangqinpu服务")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='每个请求的额外延迟(秒)')
+    parser.add_argument('--pages', type=int, default=3, help='每个琴谱的图片页数')
+    parser.add_argument('--notes', type=int, default=500, help='每轨音符数')
+    parser.add_argument('--capacity', type=int, help='同时处理的请求数上限, 超出返回429')
+    args = parser.parse_args()
+    server = StandInServer(port=args.port, latency=args.latency, pages=args.pages, notes=args.notes,
+                           capacity=args.capacity)
+    print(f"运行于 {server.base_url}, 使用方法:")
+    print(f"GANGQINPU_SITE_URL={server.base_url} GANGQINPU_API_URL={server.base_url} python main.py -i 1 --no-cache")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import metrics
+from contextlib import contextmanager
+
+# 各类响应的缓存有效期(秒), 详情会变, ccmz和图片地址对应的内容不会变
+DEFAULT_TTLS = {
+    'page': 7 * 86400,
+    'details': 600,
+    'pdfinfo': 3600,
+    'ccmz': 30 * 86400,
+    'image': 30 * 86400,
+}
+DEFAULT_MAX_BYTES = 1 << 30
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'chongchong-free')
+
+def _is_hex(name, length):
+    return len(name) == length and all(c in '0123456789abcdef' for c in name)
+
+class ResponseCache:
+    """以url为键的磁盘缓存
+
+    文件mtime记录写入时间用于判断过期, atime记录最近访问时间用于LRU淘汰。
+    写入先写临时文件再os.replace, 多线程/多进程同时写同一个url也不会读到半个文件。
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES, ttls=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._evicted = 0
+        os.makedirs(root, exist_ok=True)
+        self._size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, url):
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _entries(self):
+        # 只统计root/xx/<sha256>这种布局的文件, 同目录下的其它文件(比如索引数据库)不计入也不淘汰
+        try:
+            subdirs = [e for e in os.scandir(self.root) if _is_hex(e.name, 2) and e.is_dir()]
+        except FileNotFoundError:
+            return
+        for sub in subdirs:
+            try:
+                names = os.listdir(sub.path)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                if not (_is_hex(name, 64) and name.startswith(sub.name)):
+                    continue
+                path = os.path.join(sub.path, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, st.st_size, st.st_atime
+
+    def _count(self, kind, key, n=1):
+        metrics.current().add(f'cache.{key}', n)
+        with self._lock:
+            item = self._stats.setdefault(kind, {'hits': 0, 'misses': 0, 'stores': 0, 'stored_bytes': 0})
+            item[key] += n
+
+    def get(self, url, kind):
+        path = self._path(url)
+        ttl = self.ttls.get(kind, 0)
+        try:
+            st = os.stat(path)
+            if time.time() - st.st_mtime > ttl:
+                raise FileNotFoundError(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, (time.time(), st.st_mtime))
+        except FileNotFoundError:
+            self._count(kind, 'misses')
+            return None
+        self._count(kind, 'hits')
+        return data
+
+    def get_path(self, url, kind):
+        """未过期时返回缓存文件路径, 供流式读取; 计入命中统计"""
+        path = self._path(url)
+        try:
+            st = os.stat(path)
+            if time.time() - st.st_mtime > self.ttls.get(kind, 0):
+                raise FileNotFoundError(path)
+            os.utime(path, (time.time(), st.st_mtime))
+        except FileNotFoundError:
+            self._count(kind, 'misses')
+            return None
+        self._count(kind, 'hits')
+        return path
+
+    @contextmanager
+    def writer(self, url, kind):
+        """流式写入一个缓存项, with块正常结束才生效"""
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            self._commit(tmp, path, kind)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def _commit(self, tmp, path, kind):
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+        size = os.path.getsize(tmp)
+        os.replace(tmp, path)
+        self._count(kind, 'stores')
+        self._count(kind, 'stored_bytes', size)
+        with self._lock:
+            self._size += size - old_size
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def put(self, url, kind, data):
+        with self.writer(url, kind) as f:
+            f.write(data)
+
+    def evict(self):
+        """按最近访问时间淘汰, 直到总大小降到上限的90%"""
+        with self._lock:
+            entries = sorted(self._entries(), key=lambda e: e[2])
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            evicted = 0
+            for path, size, _ in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                evicted += 1
+            self._size = total
+            self._evicted += evicted
+
+    def stats(self):
+        with self._lock:
+            return {
+                'kinds': {kind: dict(item) for kind, item in self._stats.items()},
+                'size': self._size,
+                'evicted': self._evicted,
+            }
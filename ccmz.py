@@ -1,8 +1,20 @@
+import os
+import sys
+import mmap
+import heapq
 import zipfile
 import json
 import io
-import requests
-from midiutil.MidiFile import MIDIFile
+from collections import deque, namedtuple
+from operator import attrgetter, itemgetter
+import metrics
+import transport
+import smf
+from smf import SMFWriter
+
+# v2混淆: 偶数+1 奇数-1, 等价于 v ^ 1
+V2_TABLE = bytes(v ^ 1 for v in range(256))
+V2_CHUNK_SIZE = 1 << 16
 
 class CCMZ:
     def __init__(self):
@@ -10,226 +22,599 @@ class CCMZ:
         self.score = None
         self.midi = None
 
+# npz中音符表的列
+NOTE_COLUMNS = ('track', 'channel', 'pitch', 'start_tick', 'duration_ticks', 'velocity')
+
+# 各版本中乐谱和midi在zip里的文件名
+MEMBER_NAMES = {
+    1: {'score': 'data.xml', 'midi': 'data.mid'},
+    2: {'score': 'score.json', 'midi': 'midi.json'},
+}
+
+class _ViewReader(io.RawIOBase):
+    """memoryview上的只读文件对象, 不复制数据; 指定table时读出的字节按表转换(用于v2解混淆)"""
+
+    def __init__(self, view, table=None):
+        super().__init__()
+        self._view = memoryview(view).cast('B')
+        self._table = table
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def close(self):
+        if not self.closed:
+            # 释放对底层缓冲区(如mmap)的引用, 之后才能关闭mmap
+            self._view.release()
+        super().close()
+
+    def readinto(self, b):
+        chunk = self._view[self._pos:self._pos + len(b)]
+        n = len(chunk)
+        if self._table is not None:
+            b[:n] = chunk.tobytes().translate(self._table)
+        else:
+            b[:n] = chunk
+        self._pos += n
+        return n
+
+class LazyCCMZ:
+    """按需读取的ccmz, 和CCMZ一样有ver/score/midi, 只在访问某个成员时才解混淆并解压它"""
+
+    def __init__(self, ver, data, obfuscated=None):
+        if ver not in MEMBER_NAMES:
+            raise ValueError(f"不支持的ccmz版本: {ver}")
+        if obfuscated is None:
+            obfuscated = ver == 2
+        self.ver = ver
+        self._names = MEMBER_NAMES[ver]
+        self._reader = _ViewReader(data, V2_TABLE if obfuscated else None)
+        try:
+            self._zip = zipfile.ZipFile(self._reader)
+        except BaseException:
+            self._reader.close()
+            raise
+        self._cache = {}
+        self._mmap = None
+
+    def _name(self, name):
+        return self._names.get(name, name)
+
+    def raw(self, name):
+        """成员解压后的字节, name可以是'score'/'midi'或zip中的文件名"""
+        return self._zip.read(self._name(name))
+
+    def open(self, name):
+        """以流的方式读取成员"""
+        return self._zip.open(self._name(name))
+
+    def names(self):
+        return self._zip.namelist()
+
+    @property
+    def score(self):
+        if 'score' not in self._cache:
+            self._cache['score'] = self.raw('score').decode('utf-8')
+        return self._cache['score']
+
+    @property
+    def midi(self):
+        if 'midi' not in self._cache:
+            data = self.raw('midi')
+            # 与read_ccmz一致: v1为midi文件字节, v2为midi.json文本
+            self._cache['midi'] = data.decode('utf-8') if self.ver == 2 else data
+        return self._cache['midi']
+
+    def close(self):
+        self._zip.close()
+        self._reader.close()
+        if self._mmap is not None:
+            self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+Note = namedtuple('Note', 'track channel pitch start duration velocity')
+
+# 通道事件的两个数据字节在字典形式里的字段名
+CHANNEL_FIELDS = {
+    'noteOff': ('noteNumber', 'velocity'),
+    'noteOn': ('noteNumber', 'velocity'),
+    'noteAftertouch': ('noteNumber', 'amount'),
+    'controller': ('controllerType', 'value'),
+    'programChange': ('programNumber', None),
+    'channelAftertouch': ('amount', None),
+    'pitchBend': ('value', None),
+    'unknown': (None, None),
+}
+
+class MidiEvent(namedtuple('MidiEvent', 'type subtype channel data1 data2 fields tick track duration staff',
+                           defaults=(None,) * 9)):
+    """紧凑的事件记录
+
+    通道事件的参数放在data1/data2(弯音的14位值放在data1), 元事件和SysEx的字段放在fields。
+    tick/track/duration/staff在解码时一起传入, 不可修改; 用元组而不是Python的__init__, 创建更快。
+    """
+    __slots__ = ()
+
+    def to_dict(self):
+        """转换为parse_midi_event原来返回的字典形式"""
+        if self.type == 'channel':
+            subtype = self.subtype
+            event = {'type': 'channel', 'channel': self.channel, 'subtype': subtype}
+            name1, name2 = CHANNEL_FIELDS[subtype]
+            if name1 is not None:
+                event[name1] = self.data1
+            if name2 is not None and self.data2 is not None:
+                event[name2] = self.data2
+            return event
+        event = {'type': self.type}
+        if self.subtype is not None:
+            event['subtype'] = self.subtype
+        if self.fields:
+            event.update(self.fields)
+        return event
+
+_new_event = tuple.__new__
+
+# 解码函数的参数都是(事件字节, tick, track, duration, staff)
+def _channel_event(subtype):
+    def decode(b, tick=None, track=None, duration=None, staff=None):
+        if len(b) < 2:
+            return None
+        return _new_event(MidiEvent, ('channel', subtype, b[0] & 0x0F, b[1], b[2] if len(b) > 2 else None, None,
+                                      tick, track, duration, staff))
+    return decode
+
+def _channel_event1(subtype):
+    def decode(b, tick=None, track=None, duration=None, staff=None):
+        if len(b) < 2:
+            return None
+        return _new_event(MidiEvent, ('channel', subtype, b[0] & 0x0F, b[1], None, None,
+                                      tick, track, duration, staff))
+    return decode
+
+def _note_on(b, tick=None, track=None, duration=None, staff=None):
+    if len(b) < 2:
+        return None
+    velocity = b[2] if len(b) > 2 else None
+    return _new_event(MidiEvent, ('channel', 'noteOn' if velocity else 'noteOff', b[0] & 0x0F, b[1], velocity, None,
+                                  tick, track, duration, staff))
+
+def _pitch_bend(b, tick=None, track=None, duration=None, staff=None):
+    if len(b) < 2:
+        return None
+    return _new_event(MidiEvent, ('channel', 'pitchBend', b[0] & 0x0F, b[1] + ((b[2] << 7) if len(b) > 2 else 0),
+                                  None, None, tick, track, duration, staff))
+
+def _unknown_channel(b, tick=None, track=None, duration=None, staff=None):
+    if len(b) < 2:
+        return None
+    return _new_event(MidiEvent, ('channel', 'unknown', b[0] & 0x0F, None, None, None,
+                                  tick, track, duration, staff))
+
+def _read_length(b, pos):
+    length = 0
+    if pos < len(b):
+        byte = b[pos]
+        pos += 1
+        while byte & 0x80 and pos < len(b):
+            length = (length << 7) + (byte & 0x7F)
+            byte = b[pos]
+            pos += 1
+        length = (length << 7) + (byte & 0x7F)
+    return length, pos
+
+def _meta_text(subtype):
+    def decode(b, pos, length):
+        if pos + length <= len(b):
+            return subtype, {'text': bytes(b[pos:pos + length]).decode('utf-8', errors='ignore')}
+        return subtype, None
+    return decode
+
+def _meta_data(subtype):
+    def decode(b, pos, length):
+        if pos + length <= len(b):
+            return subtype, {'data': b[pos:pos + length]}
+        return subtype, None
+    return decode
+
+def _meta_fixed(subtype, size, parse):
+    """固定长度的元事件, 长度不符时没有subtype"""
+    def decode(b, pos, length):
+        if length != size:
+            return None, None
+        if pos + size - 1 < len(b):
+            return subtype, parse(b, pos)
+        return subtype, None
+    return decode
+
+def _smpte(b, pos):
+    byte = b[pos]
+    return {
+        'frameRate': {0: 24, 32: 25, 64: 29, 96: 30}.get(byte & 0x60, 30),
+        'hour': byte & 0x1F,
+        'min': b[pos + 1],
+        'sec': b[pos + 2],
+        'frame': b[pos + 3],
+        'subframe': b[pos + 4],
+    }
+
+_META_DECODERS = {
+    0x00: _meta_fixed('sequenceNumber', 2, lambda b, p: {'number': (b[p] << 8) + b[p + 1]}),
+    0x01: _meta_text('text'),
+    0x02: _meta_text('copyrightNotice'),
+    0x03: _meta_text('trackName'),
+    0x04: _meta_text('instrumentName'),
+    0x05: _meta_text('lyrics'),
+    0x06: _meta_text('marker'),
+    0x07: _meta_text('cuePoint'),
+    0x20: _meta_fixed('midiChannelPrefix', 1, lambda b, p: {'channel': b[p]}),
+    0x2F: _meta_fixed('endOfTrack', 0, lambda b, p: None),
+    0x51: _meta_fixed('setTempo', 3, lambda b, p: {'microsecondsPerBeat': (b[p] << 16) + (b[p + 1] << 8) + b[p + 2]}),
+    0x54: _meta_fixed('smpteOffset', 5, _smpte),
+    0x58: _meta_fixed('timeSignature', 4, lambda b, p: {
+        'numerator': b[p], 'denominator': 2 ** b[p + 1], 'metronome': b[p + 2], 'thirtyseconds': b[p + 3]}),
+    0x59: _meta_fixed('keySignature', 2, lambda b, p: {
+        'key': b[p] if b[p] <= 127 else b[p] - 256, 'scale': b[p + 1]}),
+    0x7F: _meta_data('sequencerSpecific'),
+}
+_META_UNKNOWN = _meta_data('unknown')
+
+def _meta(b, tick=None, track=None, duration=None, staff=None):
+    if len(b) < 2:
+        return None
+    length, pos = _read_length(b, 2)
+    subtype, fields = _META_DECODERS.get(b[1], _META_UNKNOWN)(b, pos, length)
+    return MidiEvent('meta', subtype, None, None, None, fields, tick, track, duration, staff)
+
+def _sysex(type):
+    def decode(b, tick=None, track=None, duration=None, staff=None):
+        length, pos = _read_length(b, 1)
+        fields = {'data': b[pos:pos + length]} if pos + length <= len(b) else None
+        return MidiEvent(type, None, None, None, None, fields, tick, track, duration, staff)
+    return decode
+
+def _build_status_decoders():
+    by_nibble = {
+        0x8: _channel_event('noteOff'),
+        0x9: _note_on,
+        0xA: _channel_event('noteAftertouch'),
+        0xB: _channel_event('controller'),
+        0xC: _channel_event1('programChange'),
+        0xD: _channel_event1('channelAftertouch'),
+        0xE: _pitch_bend,
+    }
+    table = [by_nibble.get(status >> 4, _unknown_channel) for status in range(0xF0)]
+    table += [None] * 16
+    table[0xF0] = _sysex('sysEx')
+    table[0xF7] = _sysex('dividedSysEx')
+    table[0xFF] = _meta
+    return table
+
+# 按首字节(状态字节)分派的解码表
+_STATUS_DECODERS = _build_status_decoders()
+
+def _channel_dict(subtype):
+    # parse_midi_event用: 通道事件直接生成字典, 不经过MidiEvent
+    name1, name2 = CHANNEL_FIELDS[subtype]
+
+    def build(b):
+        if len(b) < 2:
+            return None
+        if name2 is not None and len(b) > 2:
+            return {'type': 'channel', 'channel': b[0] & 0x0F, 'subtype': subtype, name1: b[1], name2: b[2]}
+        return {'type': 'channel', 'channel': b[0] & 0x0F, 'subtype': subtype, name1: b[1]}
+    return build
+
+def _note_on_dict(b):
+    if len(b) < 2:
+        return None
+    if len(b) > 2:
+        return {'type': 'channel', 'channel': b[0] & 0x0F, 'subtype': 'noteOn' if b[2] else 'noteOff',
+                'noteNumber': b[1], 'velocity': b[2]}
+    return {'type': 'channel', 'channel': b[0] & 0x0F, 'subtype': 'noteOff', 'noteNumber': b[1]}
+
+def _pitch_bend_dict(b):
+    if len(b) < 2:
+        return None
+    return {'type': 'channel', 'channel': b[0] & 0x0F, 'subtype': 'pitchBend',
+            'value': b[1] + ((b[2] << 7) if len(b) > 2 else 0)}
+
+def _unknown_channel_dict(b):
+    if len(b) < 2:
+        return None
+    return {'type': 'channel', 'channel': b[0] & 0x0F, 'subtype': 'unknown'}
+
+def _build_channel_dict_builders():
+    by_nibble = {
+        0x8: _channel_dict('noteOff'),
+        0x9: _note_on_dict,
+        0xA: _channel_dict('noteAftertouch'),
+        0xB: _channel_dict('controller'),
+        0xC: _channel_dict('programChange'),
+        0xD: _channel_dict('channelAftertouch'),
+        0xE: _pitch_bend_dict,
+    }
+    return [by_nibble.get(status >> 4, _unknown_channel_dict) for status in range(0xF0)]
+
+_CHANNEL_DICT_BUILDERS = _build_channel_dict_builders()
+
 class LibCCMZ:
     @staticmethod
     def download_ccmz(url):
         try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                return response.content
-            raise Exception(f"下载失败: {response.status_code}")
+            return transport.fetch(url, kind='ccmz')
         except Exception as e:
             print(f"ccmz文件下载失败: {e}")
             return None
 
     @staticmethod
-    def read_ccmz(buffer, callback):
+    def download_ccmz_to(url, path, chunk_size=V2_CHUNK_SIZE):
+        """流式下载ccmz并边下载边解混淆, path写入的是解混淆后的zip, 返回版本号
+
+        用open_ccmz_file(path, ver)打开。每次只在内存中保留一个块。
+        """
+        version = None
+        tmp = path + '.part'
+        try:
+            with open(tmp, 'wb') as f:
+                for chunk in transport.iter_content(url, kind='ccmz', chunk_size=chunk_size):
+                    if not chunk:
+                        continue
+                    if version is None:
+                        version = chunk[0]
+                        chunk = chunk[1:]
+                    if version == 2:
+                        chunk = chunk.translate(V2_TABLE)
+                    f.write(chunk)
+            if version is None:
+                raise ValueError("ccmz文件为空")
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return version
+
+    @staticmethod
+    def open_ccmz_file(path, ver=None):
+        """用mmap打开磁盘上的ccmz, 返回LazyCCMZ
+
+        ver为None时path是原始ccmz文件(首字节为版本号), 否则是download_ccmz_to写出的解混淆后的zip。
+        """
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mm)
+        if ver is None:
+            ver, data, obfuscated = view[0], view[1:], None
+        else:
+            data, obfuscated = view, False
+        try:
+            info = LazyCCMZ(ver, data, obfuscated)
+        except BaseException:
+            data.release()
+            view.release()
+            mm.close()
+            raise
+        data.release()
+        view.release()
+        info._mmap = mm
+        return info
+
+    @staticmethod
+    def decode_v2(data, engine='auto'):
+        """v2解混淆, data可以是bytes/bytearray/memoryview/mmap, 返回bytearray
+
+        engine: 'translate' 查表, 'numpy' 向量化异或, 'auto' 在numpy已导入时用numpy
+        """
+        view = memoryview(data).cast('B')
+        metrics.current().add('decode_v2.bytes', len(view))
+        if engine == 'auto':
+            engine = 'numpy' if 'numpy' in sys.modules else 'translate'
+
+        out = bytearray(len(view))
+        if engine == 'numpy':
+            import numpy as np
+            np.bitwise_xor(np.frombuffer(view, dtype=np.uint8), 1,
+                           out=np.frombuffer(out, dtype=np.uint8))
+        elif engine == 'translate':
+            # 分块查表, 每次只复制一个块
+            for pos in range(0, len(view), V2_CHUNK_SIZE):
+                chunk = view[pos:pos + V2_CHUNK_SIZE]
+                out[pos:pos + len(chunk)] = chunk.tobytes().translate(V2_TABLE)
+        else:
+            raise ValueError(f"未知的解码方式: {engine}")
+        return out
+
+    @staticmethod
+    def open_ccmz(buffer):
+        """返回LazyCCMZ, 不解码任何成员; buffer在LazyCCMZ使用期间不能释放"""
+        view = memoryview(buffer)
+        return LazyCCMZ(view[0], view[1:])
+
+    @staticmethod
+    def export(info, midi_output=None, npz_output=None, roll_step=None):
+        """把CCMZ/LazyCCMZ导出为MIDI文件和/或npz, 两个都要时midi只读取和解析一次
+
+        midi_output/npz_output为路径或文件对象, 为None的不写。返回(midi_output, npz_output)。
+        """
+        m = metrics.current()
+        with m.stage('read_ccmz'):
+            data = info.raw('midi') if isinstance(info, LazyCCMZ) else info.midi
+        midi_data = None
+        if info.ver == 2 or npz_output is not None:
+            with m.stage('parse_json'):
+                midi_data = json.loads(data) if info.ver == 2 else LibCCMZ.smf_to_json(data)
+        paired = False
+        if midi_output is not None:
+            if info.ver == 2:
+                with m.stage('write_midi'):
+                    LibCCMZ.write_midi(midi_data, midi_output)
+                paired = True
+            elif hasattr(midi_output, 'write'):
+                midi_output.write(data)
+            else:
+                with open(midi_output, 'wb') as f:
+                    f.write(data)
+        if npz_output is not None:
+            import numpy as np
+            with m.stage('write_npz'):
+                arrays = LibCCMZ.npz_arrays(midi_data, roll_step)
+                np.savez_compressed(npz_output, **arrays)
+            # write_midi已经计过音符数
+            if not paired:
+                m.add('notes', len(arrays['pitch']))
+        return midi_output, npz_output
+
+    @staticmethod
+    def export_midi(info, output):
+        """把CCMZ/LazyCCMZ中的midi写成标准MIDI文件, output为路径或文件对象"""
+        return LibCCMZ.export(info, output)[0]
+
+    @staticmethod
+    def read_ccmz(buffer, callback=None):
+        """完整解码乐谱和midi, 返回CCMZ; 给了callback时同时以CCMZ调用它"""
         info = CCMZ()
-        version = buffer[0]
+        view = memoryview(buffer)
+        version = view[0]
         info.ver = version
-        data = buffer[1:]
+        data = view[1:]
 
         if version == 1:
             zip_file = zipfile.ZipFile(io.BytesIO(data))
             info.score = zip_file.read("data.xml").decode('utf-8')
             info.midi = zip_file.read("data.mid")
         elif version == 2:
-            data = bytes([v + 1 if v % 2 == 0 else v - 1 for v in data])
+            data = LibCCMZ.decode_v2(data)
             zip_file = zipfile.ZipFile(io.BytesIO(data))
             info.score = zip_file.read("score.json").decode('utf-8')
             info.midi = zip_file.read("midi.json").decode('utf-8')
-        callback(info)
+        if callback is not None:
+            callback(info)
+        return info
+
+    @staticmethod
+    def decode_event(event_bytes, tick=None, track=None, duration=None, staff=None):
+        """解析单个事件字节, 返回MidiEvent, 无法解析时返回None"""
+        if not event_bytes:
+            return None
+        decoder = _STATUS_DECODERS[event_bytes[0]]
+        return decoder(event_bytes, tick, track, duration, staff) if decoder else None
 
     @staticmethod
     def parse_midi_event(event_bytes):
-        if not event_bytes or len(event_bytes) == 0:
+        """解析单个事件字节, 返回字典; 通道事件直接生成字典, 其它事件经MidiEvent.to_dict()"""
+        if not event_bytes:
             return None
-        
-        first_byte = event_bytes[0]
-        
-        if (first_byte & 0xF0) != 0xF0:
-            event_type = first_byte >> 4
-            channel = first_byte & 0x0F
-            
-            if len(event_bytes) < 2:
-                return None
-                
-            event = {'type': 'channel', 'channel': channel}
-            
-            if event_type == 0x8:
-                event['subtype'] = 'noteOff'
-                event['noteNumber'] = event_bytes[1]
-                if len(event_bytes) > 2:
-                    event['velocity'] = event_bytes[2]
-            elif event_type == 0x9:
-                event['noteNumber'] = event_bytes[1]
-                if len(event_bytes) > 2:
-                    event['velocity'] = event_bytes[2]
-                event['subtype'] = 'noteOff' if event.get('velocity', 0) == 0 else 'noteOn'
-            elif event_type == 0xA:
-                event['subtype'] = 'noteAftertouch'
-                event['noteNumber'] = event_bytes[1]
-                if len(event_bytes) > 2:
-                    event['amount'] = event_bytes[2]
-            elif event_type == 0xB:
-                event['subtype'] = 'controller'
-                event['controllerType'] = event_bytes[1]
-                if len(event_bytes) > 2:
-                    event['value'] = event_bytes[2]
-            elif event_type == 0xC:
-                event['subtype'] = 'programChange'
-                event['programNumber'] = event_bytes[1]
-            elif event_type == 0xD:
-                event['subtype'] = 'channelAftertouch'
-                event['amount'] = event_bytes[1]
-            elif event_type == 0xE:
-                event['subtype'] = 'pitchBend'
-                event['value'] = event_bytes[1] + ((event_bytes[2] << 7) if len(event_bytes) > 2 else 0)
-            else:
-                event['subtype'] = 'unknown'
-            
-            return event
-        
-        elif first_byte == 0xFF:
-            if len(event_bytes) < 2:
-                return None
-            
-            event = {'type': 'meta'}
-            meta_type = event_bytes[1]
-            
-            length = 0
-            pos = 2
-            if pos < len(event_bytes):
-                byte = event_bytes[pos]
-                pos += 1
-                while byte & 0x80 and pos < len(event_bytes):
-                    length = (length << 7) + (byte & 0x7F)
-                    byte = event_bytes[pos]
-                    pos += 1
-                length = (length << 7) + (byte & 0x7F)
-            
-            if meta_type == 0x00:
-                if length == 2:
-                    event['subtype'] = 'sequenceNumber'
-                    if pos + 1 < len(event_bytes):
-                        event['number'] = (event_bytes[pos] << 8) + event_bytes[pos + 1]
-            elif meta_type == 0x01:
-                event['subtype'] = 'text'
-                if pos + length <= len(event_bytes):
-                    event['text'] = event_bytes[pos:pos+length].decode('utf-8', errors='ignore')
-            elif meta_type == 0x02:
-                event['subtype'] = 'copyrightNotice'
-                if pos + length <= len(event_bytes):
-                    event['text'] = event_bytes[pos:pos+length].decode('utf-8', errors='ignore')
-            elif meta_type == 0x03:
-                event['subtype'] = 'trackName'
-                if pos + length <= len(event_bytes):
-                    event['text'] = event_bytes[pos:pos+length].decode('utf-8', errors='ignore')
-            elif meta_type == 0x04:
-                event['subtype'] = 'instrumentName'
-                if pos + length <= len(event_bytes):
-                    event['text'] = event_bytes[pos:pos+length].decode('utf-8', errors='ignore')
-            elif meta_type == 0x05:
-                event['subtype'] = 'lyrics'
-                if pos + length <= len(event_bytes):
-                    event['text'] = event_bytes[pos:pos+length].decode('utf-8', errors='ignore')
-            elif meta_type == 0x06:
-                event['subtype'] = 'marker'
-                if pos + length <= len(event_bytes):
-                    event['text'] = event_bytes[pos:pos+length].decode('utf-8', errors='ignore')
-            elif meta_type == 0x07:
-                event['subtype'] = 'cuePoint'
-                if pos + length <= len(event_bytes):
-                    event['text'] = event_bytes[pos:pos+length].decode('utf-8', errors='ignore')
-            elif meta_type == 0x20:
-                if length == 1:
-                    event['subtype'] = 'midiChannelPrefix'
-                    if pos < len(event_bytes):
-                        event['channel'] = event_bytes[pos]
-            elif meta_type == 0x2F:
-                if length == 0:
-                    event['subtype'] = 'endOfTrack'
-            elif meta_type == 0x51:
-                if length == 3:
-                    event['subtype'] = 'setTempo'
-                    if pos + 2 < len(event_bytes):
-                        event['microsecondsPerBeat'] = (event_bytes[pos] << 16) + (event_bytes[pos + 1] << 8) + event_bytes[pos + 2]
-            elif meta_type == 0x54:
-                if length == 5:
-                    event['subtype'] = 'smpteOffset'
-                    if pos + 4 < len(event_bytes):
-                        byte = event_bytes[pos]
-                        event['frameRate'] = {0: 24, 32: 25, 64: 29, 96: 30}.get(byte & 0x60, 30)
-                        event['hour'] = byte & 0x1F
-                        event['min'] = event_bytes[pos + 1]
-                        event['sec'] = event_bytes[pos + 2]
-                        event['frame'] = event_bytes[pos + 3]
-                        event['subframe'] = event_bytes[pos + 4]
-            elif meta_type == 0x58:
-                if length == 4:
-                    event['subtype'] = 'timeSignature'
-                    if pos + 3 < len(event_bytes):
-                        event['numerator'] = event_bytes[pos]
-                        event['denominator'] = 2 ** event_bytes[pos + 1]
-                        event['metronome'] = event_bytes[pos + 2]
-                        event['thirtyseconds'] = event_bytes[pos + 3]
-            elif meta_type == 0x59:
-                if length == 2:
-                    event['subtype'] = 'keySignature'
-                    if pos + 1 < len(event_bytes):
-                        event['key'] = event_bytes[pos] if event_bytes[pos] <= 127 else event_bytes[pos] - 256
-                        event['scale'] = event_bytes[pos + 1]
-            elif meta_type == 0x7F:
-                event['subtype'] = 'sequencerSpecific'
-                if pos + length <= len(event_bytes):
-                    event['data'] = event_bytes[pos:pos+length]
-            else:
-                event['subtype'] = 'unknown'
-                if pos + length <= len(event_bytes):
-                    event['data'] = event_bytes[pos:pos+length]
-            
-            return event
-        
-        elif first_byte == 0xF0:
-            event = {'type': 'sysEx'}
-            length = 0
-            pos = 1
-            if pos < len(event_bytes):
-                byte = event_bytes[pos]
-                pos += 1
-                while byte & 0x80 and pos < len(event_bytes):
-                    length = (length << 7) + (byte & 0x7F)
-                    byte = event_bytes[pos]
-                    pos += 1
-                length = (length << 7) + (byte & 0x7F)
-            
-            if pos + length <= len(event_bytes):
-                event['data'] = event_bytes[pos:pos+length]
+        status = event_bytes[0]
+        if status < 0xF0:
+            return _CHANNEL_DICT_BUILDERS[status](event_bytes)
+        decoder = _STATUS_DECODERS[status]
+        event = decoder(event_bytes) if decoder else None
+        return event.to_dict() if event else None
+
+    @staticmethod
+    def iter_track_events(events, track_count, stats=None):
+        """把midi.json的事件按轨道拆开, 各轨按tick排序后多路归并, 逐个解码产出MidiEvent
+
+        只保存原始事件的引用, 解码后的事件用完即丢。stats不为None时按类型计数。
+        """
+        per_track = [[] for _ in range(track_count)]
+        for event in events:
+            track_id = event.get('track', 0)
+            per_track[track_id if track_id < track_count else 0].append(event)
+
+        def stream(track_id, track_events):
+            # 已经有序时timsort只需线性扫描一遍
+            track_events.sort(key=itemgetter('tick'))
+            # 直接查分派表, 省掉decode_event这一层调用
+            decoders = _STATUS_DECODERS
+            for event in track_events:
+                b = event.get('event')
+                decoder = decoders[b[0]] if b else None
+                if decoder is None:
+                    continue
+                parsed_event = decoder(b, event['tick'], track_id, event.get('duration', 0), event.get('staff', 0))
+                if parsed_event is None:
+                    continue
+                if stats is not None:
+                    key = parsed_event.subtype if parsed_event.type == 'channel' else parsed_event.type
+                    stats[key] = stats.get(key, 0) + 1
+                yield parsed_event
+
+        streams = [stream(i, track_events) for i, track_events in enumerate(per_track) if track_events]
+        return heapq.merge(*streams, key=attrgetter('tick'))
+
+    @staticmethod
+    def pair_notes(stream, on_other=None, min_duration=10):
+        """把tick有序的事件流配对成音符, 音符结束时立即产出Note
+
+        同一(轨道, 通道, 音高)上的noteOn按先进先出排队, noteOff关闭最早的一个, 重叠的音符不会互相覆盖。
+        流结束时仍未关闭的音符: 事件自带时值(duration)时按时值结束, 否则在所在轨道的最后一个事件处结束。
+        所有音符时值至少为min_duration。非音符的事件交给on_other处理。
+        """
+        open_notes = {}
+        last_tick = {}
+        for parsed_event in stream:
+            last_tick[parsed_event.track] = parsed_event.tick
+            subtype = parsed_event.subtype
             
-            return event
-        
-        elif first_byte == 0xF7:
-            event = {'type': 'dividedSysEx'}
-            length = 0
-            pos = 1
-            if pos < len(event_bytes):
-                byte = event_bytes[pos]
-                pos += 1
-                while byte & 0x80 and pos < len(event_bytes):
-                    length = (length << 7) + (byte & 0x7F)
-                    byte = event_bytes[pos]
-                    pos += 1
-                length = (length << 7) + (byte & 0x7F)
+            if subtype == 'noteOn':
+                key = (parsed_event.track, parsed_event.channel, parsed_event.data1)
+                queue = open_notes.get(key)
+                if queue is None:
+                    queue = open_notes[key] = deque()
+                queue.append(parsed_event)
             
-            if pos + length <= len(event_bytes):
-                event['data'] = event_bytes[pos:pos+length]
+            elif subtype == 'noteOff':
+                key = (parsed_event.track, parsed_event.channel, parsed_event.data1)
+                queue = open_notes.get(key)
+                if queue:
+                    note_on = queue.popleft()
+                    if not queue:
+                        del open_notes[key]
+                    yield Note(note_on.track, note_on.channel, note_on.data1, note_on.tick,
+                               max(min_duration, parsed_event.tick - note_on.tick), note_on.data2)
+                elif parsed_event.data2:
+                    # 没有对应noteOn但带力度的noteOff, 按自身时值当作一个音符
+                    yield Note(parsed_event.track, parsed_event.channel, parsed_event.data1,
+                               parsed_event.tick, max(min_duration, parsed_event.duration or 0),
+                               parsed_event.data2)
             
-            return event
+            elif on_other is not None and parsed_event.type == 'channel':
+                on_other(parsed_event)
         
-        return None
+        for queue in open_notes.values():
+            for note_on in queue:
+                if note_on.duration:
+                    duration = note_on.duration
+                else:
+                    duration = last_tick[note_on.track] - note_on.tick
+                yield Note(note_on.track, note_on.channel, note_on.data1, note_on.tick,
+                           max(min_duration, duration), note_on.data2)
 
     @staticmethod
     def write_midi(data, output):
+        """output为路径或可写的文件对象"""
         ticks_per_beat = 480
         tempos = data.get('tempos', [])
         tracks = data.get('tracks', [])
@@ -240,125 +625,200 @@ class LibCCMZ:
         
         track_count = len(tracks) if tracks else 1
         
-        midi = MIDIFile(track_count)
+        midi = SMFWriter(track_count, ticks_per_beat)
         
-        initial_tempo = 500000
-        if tempos and tempos[0].get('tempo'): #其实我觉得不太可能取不到
-            initial_tempo = tempos[0]['tempo']
+        for tempo in tempos:
+            if tempo.get('tempo'):
+                midi.add_tempo(int(round(tempo.get('tick') or 0)), tempo['tempo'])
+        if not any(t.get('tempo') for t in tempos): #其实我觉得不太可能取不到
+            midi.add_tempo(0, 500000)
         
         for idx in range(track_count):
             if tracks and idx < len(tracks):
                 track_name = tracks[idx].get('name', f'Track{idx}')
-                midi.addTrackName(idx, 0, track_name)
-            
-            bpm = round(60000000 / initial_tempo)
-            midi.addTempo(idx, 0, bpm)
-            
-            if tracks and idx < len(tracks):
+                midi.add_track_name(idx, 0, track_name)
                 program = tracks[idx].get('program', 0)
-                midi.addProgramChange(idx, 0, 0, program)
-        
-        track_events = {}
-        all_parsed_events = []
+                midi.add_program_change(idx, 0, 0, program)
         
         event_stats = {
             'noteOn': 0, 'noteOff': 0, 'controller': 0,
             'programChange': 0, 'meta': 0, 'unknown': 0
         }
         
-        for event in events:
-            track_id = event.get('track', 0)
-            if track_id >= track_count:
-                track_id = 0
-            
-            event_bytes = event.get('event', [])
-            parsed_event = LibCCMZ.parse_midi_event(event_bytes)
-            
-            if parsed_event:
-                parsed_event['tick'] = event['tick']
-                parsed_event['duration'] = event.get('duration', 0)
-                parsed_event['staff'] = event.get('staff', 0)
-                parsed_event['track'] = track_id
-                
-                if track_id not in track_events:
-                    track_events[track_id] = []
-                track_events[track_id].append(parsed_event)
-                all_parsed_events.append(parsed_event)
-                
-                if parsed_event['type'] == 'channel':
-                    event_stats[parsed_event.get('subtype', 'unknown')] += 1
-                else:
-                    event_stats[parsed_event['type']] += 1
+        def on_other(parsed_event):
+            if parsed_event.subtype == 'controller':
+                if parsed_event.data1 in (1, 7, 11, 64, 65, 66, 67, 68):
+                    midi.add_controller(parsed_event.track, 0, parsed_event.tick,
+                                        parsed_event.data1, parsed_event.data2 or 0)
+            elif parsed_event.subtype == 'pitchBend':
+                # 事件里已经是0~16383的原始值
+                midi.add_pitch_bend(parsed_event.track, 0, parsed_event.tick, parsed_event.data1)
         
-        note_on_map = {}
+        stream = LibCCMZ.iter_track_events(events, track_count, event_stats)
+        note_count = 0
+        for note in LibCCMZ.pair_notes(stream, on_other):
+            midi.add_note(note.track, 0, note.pitch, note.start, note.duration, note.velocity)
+            note_count += 1
         
-        for parsed_event in all_parsed_events:
-            if parsed_event['type'] == 'channel':
-                if parsed_event['subtype'] == 'noteOn':
-                    key = (parsed_event['track'], parsed_event.get('channel', 0), parsed_event.get('noteNumber', 0))
-                    note_on_map[key] = parsed_event
-                
-                elif parsed_event['subtype'] == 'noteOff':
-                    key = (parsed_event['track'], parsed_event.get('channel', 0), parsed_event.get('noteNumber', 0))
-                    
-                    if key in note_on_map:
-                        note_on = note_on_map[key]
-                        
-                        start_tick = note_on['tick']
-                        end_tick = parsed_event['tick']
-                        duration_ticks = max(10, end_tick - start_tick)
-                        
-                        start_time = start_tick / ticks_per_beat
-                        duration_sec = duration_ticks / ticks_per_beat
-                        velocity = note_on.get('velocity', 90)
-                        
-                        track_idx = parsed_event['track']
-                        if track_idx >= track_count:
-                            track_idx = track_count - 1
-                        
-                        midi.addNote(track_idx, 0, note_on['noteNumber'], 
-                                   start_time, duration_sec, velocity)
-                        
-                        del note_on_map[key]
-                    
-                    else:
-                        track_idx = parsed_event['track']
-                        if track_idx >= track_count:
-                            track_idx = track_count - 1
-                        
-                        note_number = parsed_event.get('noteNumber', 60)
-                        velocity = parsed_event.get('velocity', 0)
-                        
-                        if velocity > 0:
-                            start_time = parsed_event['tick'] / ticks_per_beat
-                            duration_sec = parsed_event.get('duration', 10) / ticks_per_beat
-                            midi.addNote(track_idx, 0, note_number, 
-                                       start_time, duration_sec, velocity)
-                
-                elif parsed_event['subtype'] == 'controller':
-                    track_idx = parsed_event['track']
-                    if track_idx >= track_count:
-                        track_idx = track_count - 1
-                    
-                    controller_type = parsed_event.get('controllerType', 0)
-                    value = parsed_event.get('value', 0)
-                    time = parsed_event['tick'] / ticks_per_beat
-                    
-                    if controller_type in [1, 7, 11, 64, 65, 66, 67, 68]:
-                        midi.addControllerEvent(track_idx, 0, time, 
-                                              controller_type, value)
-                
-                elif parsed_event['subtype'] == 'pitchBend':
-                    track_idx = parsed_event['track']
-                    if track_idx >= track_count:
-                        track_idx = track_count - 1
-                    
-                    pitch_value = parsed_event.get('value', 8192)
-                    normalized_value = ((pitch_value + 8192) * 16383) // 16383
-                    time = parsed_event['tick'] / ticks_per_beat
-                    
-                    midi.addPitchWheelEvent(track_idx, 0, time, normalized_value)
+        m = metrics.current()
+        if m.enabled:
+            for key, n in event_stats.items():
+                m.add(f'events.{key}', n)
+            m.add('notes', note_count)
         
-        with open(output, 'wb') as f:
-            midi.writeFile(f)
+        if hasattr(output, 'write'):
+            midi.write(output)
+        else:
+            with open(output, 'wb') as f:
+                midi.write(f)
+        return output
+
+    @staticmethod
+    def smf_to_json(data):
+        """把标准MIDI文件(v1的data.mid)转换成midi.json的结构, 每个MTrk为一轨"""
+        ticks_per_beat, chunks = smf.read_tracks(data)
+        tempos, tracks, events = [], [], []
+        for idx, chunk in enumerate(chunks):
+            if idx == 0 and not any(event[0] < 0xF0 for _, event in chunk):
+                # 只有速度等元事件的第0轨不算作音轨, 与midi.json的轨道序号一致
+                tempos.extend({'tick': tick, 'tempo': int.from_bytes(event[3:6], 'big')}
+                              for tick, event in chunk if event[:2] == b'\xff\x51')
+                continue
+            track_id = len(tracks)
+            name = f'Track{track_id}'
+            for tick, event in chunk:
+                if event[:2] == b'\xff\x51':
+                    tempos.append({'tick': tick, 'tempo': int.from_bytes(event[3:6], 'big')})
+                elif event[:2] == b'\xff\x03' and tick == 0:
+                    name = event[3:].decode('utf-8', errors='replace')
+                events.append({'tick': tick, 'track': track_id, 'event': list(event)})
+            tracks.append({'name': name})
+        return {'ticks_per_beat': ticks_per_beat, 'tempos': tempos, 'tracks': tracks, 'events': events}
+
+    @staticmethod
+    def note_arrays(data, min_duration=10):
+        """把midi.json的音符配对成列式数组(需要numpy), 配对规则与pair_notes相同
+
+        返回{列名: 数组}, 列见NOTE_COLUMNS, 按开始tick排序; 另有tempo_tick/tempo表示速度变化。
+        除了取出事件字段, 配对全部用数组运算完成。
+        """
+        import numpy as np
+
+        tracks = data.get('tracks', [])
+        track_count = len(tracks) if tracks else 1
+        # 只在取字段时逐个访问事件, 每列一个列表推导; 与decode_event一样, 只有SysEx可以只有1个字节
+        decodable = [e for e in data.get('events', [])
+                     if (ev := e.get('event')) and _STATUS_DECODERS[ev[0]] is not None
+                     and (len(ev) > 1 or ev[0] in (0xF0, 0xF7))]
+        raw = [e['event'] for e in decodable]
+        tick = np.array([e['tick'] for e in decodable], dtype=np.int64)
+        track = np.array([e.get('track', 0) for e in decodable], dtype=np.int64)
+        track = np.where(track < track_count, track, 0)
+        status = np.array([ev[0] for ev in raw], dtype=np.int64)
+        pitch = np.array([ev[1] if len(ev) > 1 else 0 for ev in raw], dtype=np.int64)
+        velocity = np.array([ev[2] if len(ev) > 2 else 0 for ev in raw], dtype=np.int64)
+        duration = np.array([e.get('duration') or 0 for e in decodable], dtype=np.int64)
+
+        # 各轨最后一个事件的tick, 用于结束未关闭的音符
+        last_tick = np.zeros(track_count, dtype=np.int64)
+        np.maximum.at(last_tick, track, tick)
+
+        # 2字节的0x8n/0x9n(没有力度)也是noteOff, 和pair_notes一样可以关闭音符
+        note = (status >= 0x80) & (status < 0xA0)
+        tick, track, status = tick[note], track[note], status[note]
+        pitch, velocity, duration = pitch[note], velocity[note], duration[note]
+        channel = status & 0x0F
+        is_on = ((status & 0xF0) == 0x90) & (velocity > 0)
+
+        # 按(轨道, 通道, 音高, tick)稳定排序, 同一个键的事件连续且保持原顺序
+        key = (track * 16 + channel) * 256 + pitch
+        order = np.lexsort((tick, key))
+        key, tick, is_on = key[order], tick[order], is_on[order]
+        track, channel, pitch = track[order], channel[order], pitch[order]
+        velocity, duration = velocity[order], duration[order]
+        n = len(key)
+        starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]]) if n else np.zeros(0, dtype=np.int64)
+        group = np.cumsum(np.r_[True, key[1:] != key[:-1]]) - 1 if n else np.zeros(0, dtype=np.int64)
+
+        # 每组内noteOn记+1、noteOff记-1, 余量(不低于0)大于0时的noteOff才能关闭音符
+        step = np.where(is_on, 1, -1)
+        walk = np.cumsum(step)
+        walk -= np.repeat(walk[starts] - step[starts], np.diff(np.r_[starts, n]))
+        # 后面的组整体下移, 全局累计最小值就等于组内累计最小值
+        shift = group * (2 * n + 2)
+        floor = np.minimum(np.minimum.accumulate(walk - shift) + shift, 0)
+        before = np.r_[0, (walk - floor)[:-1]] if n else walk
+        before[starts] = 0
+        closing = ~is_on & (before > 0)
+
+        # 先进先出: 组内第k个有效noteOff关闭组内第k个noteOn
+        on_idx = np.flatnonzero(is_on)
+        off_idx = np.flatnonzero(closing)
+        off_rank = np.arange(len(off_idx)) - np.searchsorted(off_idx, starts)[group[off_idx]]
+        pair_on = on_idx[np.searchsorted(on_idx, starts)[group[off_idx]] + off_rank]
+        end = np.full(n, -1, dtype=np.int64)
+        end[pair_on] = tick[off_idx]
+
+        on_dur = np.where(end[on_idx] >= 0, end[on_idx] - tick[on_idx],
+                          np.where(duration[on_idx] > 0, duration[on_idx],
+                                   last_tick[track[on_idx]] - tick[on_idx]))
+        # 没有对应noteOn但带力度的noteOff, 按自身时值当作一个音符
+        stray = np.flatnonzero(~is_on & ~closing & (velocity > 0))
+        idx = np.r_[on_idx, stray]
+        dur = np.maximum(np.r_[on_dur, duration[stray]], min_duration)
+        result = {'track': track[idx], 'channel': channel[idx], 'pitch': pitch[idx],
+                  'start_tick': tick[idx], 'duration_ticks': dur, 'velocity': velocity[idx]}
+        order = np.lexsort((result['pitch'], result['track'], result['start_tick']))
+        dtypes = {'track': np.int16, 'channel': np.uint8, 'pitch': np.uint8, 'start_tick': np.int64,
+                  'duration_ticks': np.int64, 'velocity': np.uint8}
+        result = {name: result[name][order].astype(dtypes[name]) for name in NOTE_COLUMNS}
+
+        tempos = [(t.get('tick', 0), t['tempo']) for t in data.get('tempos', []) if t.get('tempo')]
+        tempos = np.array(sorted(tempos) or [(0, 500000)], dtype=np.int64)
+        result['tempo_tick'] = tempos[:, 0]
+        result['tempo'] = tempos[:, 1]
+        result['ticks_per_beat'] = np.int64(data.get('ticks_per_beat', 480))
+        return result
+
+    @staticmethod
+    def piano_roll(notes, step=120):
+        """由note_arrays的结果生成(128, 列数)的力度矩阵, 每列step个tick"""
+        import numpy as np
+
+        first = notes['start_tick'] // step
+        last = -(-(notes['start_tick'] + notes['duration_ticks']) // step)
+        width = int(last.max()) if len(last) else 0
+        roll = np.zeros((128, width), dtype=np.uint8)
+        lengths = np.maximum(last - first, 1)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        cols = np.repeat(first, lengths) + offsets
+        # 和写midi时一样只取低7位, 超出范围的音高不会越界
+        np.maximum.at(roll, (np.repeat(notes['pitch'] & 0x7F, lengths), cols),
+                      np.repeat(notes['velocity'].astype(np.uint8) & 0x7F, lengths))
+        return roll
+
+    @staticmethod
+    def npz_arrays(data, roll_step=None):
+        """write_npz要写的数组字典"""
+        import numpy as np
+
+        arrays = LibCCMZ.note_arrays(data)
+        if roll_step:
+            arrays['piano_roll'] = LibCCMZ.piano_roll(arrays, roll_step)
+            arrays['roll_step'] = np.int64(roll_step)
+        return arrays
+
+    @staticmethod
+    def write_npz(data, output, roll_step=None):
+        """把midi.json结构写成npz, roll_step不为None时附带piano_roll矩阵; output为路径或文件对象"""
+        import numpy as np
+
+        arrays = LibCCMZ.npz_arrays(data, roll_step)
+        metrics.current().add('notes', len(arrays['pitch']))
+        np.savez_compressed(output, **arrays)
         return output
+
+    @staticmethod
+    def export_npz(info, output, roll_step=None):
+        """把CCMZ/LazyCCMZ中的音符写成npz, v1的data.mid先转换成midi.json结构"""
+        return LibCCMZ.export(info, npz_output=output, roll_step=roll_step)[1]
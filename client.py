@@ -0,0 +1,263 @@
+"""可在其它程序中直接调用的接口, 结果以bytes返回或写入任意文件对象, 不经过磁盘
+
+    import client
+    score = client.fetch_score(942280)
+    midi = client.to_midi_bytes(client.fetch_ccmz(score))
+    pdf = client.render_pdf_bytes(client.fetch_images(score))
+
+每个函数都有对应的async版本(名字加_async), 在线程池里执行, 不阻塞事件循环。
+"""
+import re
+import io
+import os
+import json
+import asyncio
+import contextvars
+from collections import namedtuple
+import metrics
+import transport
+from ccmz import LibCCMZ, CCMZ, LazyCCMZ
+
+# 可以用环境变量指向本地的模拟服务(见bench_server.py)
+SITE_URL = os.environ.get('GANGQINPU_SITE_URL', 'https://www.gangqinpu.com')
+API_URL = os.environ.get('GANGQINPU_API_URL', 'https://gangqinpu.lzjoy.com')
+
+def httpget(url, headers=None, kind=None):
+    return transport.fetch(url, kind=kind, headers=headers).decode('utf-8', errors='replace')
+
+def get_music_id(param):
+    match = re.search(r'(\d+)', param)
+    return match.group(1) if match else None
+
+def get_opern_id(music_id):
+    url = f"{SITE_URL}/cchtml/{music_id}.htm"
+    with metrics.current().stage('scrape'):
+        text = httpget(url, kind='page')
+    match = re.search(r'data-oid="(\d+)"', text)
+    if not match:
+        print("OpernID找不到")
+        return None
+    return match.group(1)
+
+def details_url(opern_id):
+    return f"{API_URL}?urlparam=pad/detail/operninfov002&old_id={opern_id}"
+
+def pdf_info_url(music_id):
+    return f"{API_URL}/?urlparam=home/user/getOpernDetail&id={music_id}"
+
+def get_details(opern_id):
+    return httpget(details_url(opern_id), kind='details')
+
+def get_pdf_info(music_id):
+    response = httpget(pdf_info_url(music_id), kind='pdfinfo')
+    data = json.loads(response)
+    
+    if data.get('returnMsg') != 'ok':
+        return None
+    
+    return data.get('list', {})
+
+def fetch_image(img_url):
+    return transport.fetch(img_url, kind='image')
+
+def iter_images(image_list, workers=8):
+    """并发下载曲谱图片, 按页序产出(页码, 内容, 错误)
+
+    同时进行的请求不超过workers个, 已下载未取走的页面不超过2*workers个
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+
+    workers = max(1, workers)
+    urls = enumerate(image_list, 1)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit():
+            item = next(urls, None)
+            if item is not None:
+                # 带上当前上下文, 下载线程里的计数记到同一个Metrics
+                pending.append((item[0], pool.submit(contextvars.copy_context().run,
+                                                     fetch_image, item[1])))
+
+        for _ in range(workers * 2):
+            submit()
+        while pending:
+            i, future = pending.popleft()
+            submit()
+            try:
+                content = future.result()
+            except Exception as e:
+                yield i, None, e
+            else:
+                yield i, content, None
+
+def render_pdf(pages, output, log=print):
+    """把按页序产出(页码, 内容, 错误)的图片边下载边写入pdf, output为路径或文件对象
+
+    有缺页时返回False且不写出pdf
+    """
+    from reportlab import rl_config
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import ImageReader
+
+    # 图片数据直接以二进制写入, ASCII85编码会让pdf大25%
+    rl_config.useA85 = 0
+    
+    c = None
+    failed = []
+    for i, content, error in pages:
+        if error is not None:
+            log(f"第{i}页下载失败: {error}")
+            failed.append(i)
+            continue
+        if failed:
+            # 已经缺页, 剩下的只下载不排版, 以便报告所有失败页
+            continue
+        if c is None:
+            c = canvas.Canvas(output, pagesize=A4)
+        
+        # ImageReader只解析图片头就能得到尺寸
+        img = ImageReader(io.BytesIO(content))
+        img_width, img_height = img.getSize()
+        
+        page_width, page_height = A4
+        scale_x = page_width / img_width
+        scale_y = page_height / img_height
+        scale = min(scale_x, scale_y)
+        
+        new_width = img_width * scale
+        new_height = img_height * scale
+        x = (page_width - new_width) / 2
+        y = (page_height - new_height) / 2
+        
+        c.drawImage(img, x, y, new_width, new_height)
+        c.showPage()
+    
+    if c is None or failed:
+        return False
+    c.save()
+    return True
+
+def safe_filename(name):
+    return ''.join(c if c not in '/\\:*?"<>|' else ' ' for c in name)
+
+class ScoreError(Exception):
+    pass
+
+def lookup_opern_id(music_id, index=None):
+    """先查本地索引, 查不到再抓取琴谱页面"""
+    if index is not None:
+        row = index.get(music_id)
+        if row:
+            metrics.current().add('index.hits')
+            return row['opern_id']
+        metrics.current().add('index.misses')
+    opern_id = get_opern_id(music_id)
+    if opern_id and index is not None:
+        index.put(music_id, opern_id)
+    return opern_id
+
+class Score(namedtuple('Score', 'music_id opern_id details')):
+    """一个琴谱的基本信息, details为详情接口返回的list"""
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return self.details['name']
+
+    @property
+    def file_name(self):
+        return f"{safe_filename(self.details['name'])}-{safe_filename(self.details['typename'])}"
+
+    @property
+    def ccmz_url(self):
+        return self.details.get('play_json')
+
+def fetch_score(input_param, index=None, opern_id=None):
+    """按琴谱id或url获取Score; 给了index时先查索引, 并把结果写回索引"""
+    music_id = get_music_id(str(input_param))
+    if not music_id:
+        raise ScoreError("无法识别id")
+    if not opern_id:
+        opern_id = lookup_opern_id(music_id, index)
+    if not opern_id:
+        raise ScoreError("无法获取OpernID")
+    with metrics.current().stage('details'):
+        details = json.loads(get_details(opern_id))['list']
+    if index is not None:
+        index.put(music_id, opern_id, details)
+    return Score(music_id, opern_id, details)
+
+def fetch_ccmz(score):
+    """下载ccmz原始内容(含版本字节)"""
+    if not score.ccmz_url:
+        raise ScoreError('无MIDI可下载')
+    with metrics.current().stage('ccmz_download'):
+        data = LibCCMZ.download_ccmz(score.ccmz_url)
+    if not data:
+        raise ScoreError('ccmz文件下载失败')
+    return data
+
+def fetch_image_list(score):
+    """曲谱图片地址列表, 没有图片时为空列表"""
+    music_id = score.music_id if isinstance(score, Score) else str(score)
+    with metrics.current().stage('pdfinfo'):
+        pdf_info = get_pdf_info(music_id)
+    return list((pdf_info or {}).get('image_list') or [])
+
+def fetch_images(score, workers=8):
+    """按页序下载全部曲谱图片, 返回bytes列表, 有缺页时抛出ScoreError"""
+    pages = []
+    failed = []
+    for i, content, error in iter_images(fetch_image_list(score), workers):
+        if error is not None:
+            failed.append(f"第{i}页: {error}")
+        else:
+            pages.append(content)
+    if failed:
+        raise ScoreError("图片下载失败: " + '; '.join(failed))
+    return pages
+
+def to_midi_bytes(ccmz, output=None):
+    """把ccmz(原始bytes、CCMZ或LazyCCMZ)转换成标准MIDI文件
+
+    不传output时返回bytes, 否则写入output(路径或文件对象)并返回output。
+    """
+    if not isinstance(ccmz, (CCMZ, LazyCCMZ)):
+        ccmz = LibCCMZ.open_ccmz(ccmz)
+    out = io.BytesIO() if output is None else output
+    LibCCMZ.export_midi(ccmz, out)
+    return out.getvalue() if output is None else output
+
+def to_npz_bytes(ccmz, output=None, roll_step=None):
+    """把ccmz中的音符导出为npz列式数组(需要numpy), roll_step不为None时附带钢琴卷帘, output的用法同to_midi_bytes"""
+    if not isinstance(ccmz, (CCMZ, LazyCCMZ)):
+        ccmz = LibCCMZ.open_ccmz(ccmz)
+    out = io.BytesIO() if output is None else output
+    LibCCMZ.export_npz(ccmz, out, roll_step)
+    return out.getvalue() if output is None else output
+
+def render_pdf_bytes(images, output=None):
+    """把按页序排列的图片(bytes)排版成A4的pdf, output的用法同to_midi_bytes"""
+    out = io.BytesIO() if output is None else output
+    errors = []
+    if not render_pdf(((i, content, None) for i, content in enumerate(images, 1)), out, log=errors.append):
+        raise ScoreError("PDF生成失败" + (": " + '; '.join(errors) if errors else ": 没有图片"))
+    return out.getvalue() if output is None else output
+
+def _in_thread(func):
+    async def wrapper(*args, **kwargs):
+        # to_thread会带上当前上下文, 指标照常记录
+        return await asyncio.to_thread(func, *args, **kwargs)
+    wrapper.__name__ = func.__name__ + '_async'
+    wrapper.__doc__ = f"{func.__name__}的async版本"
+    return wrapper
+
+fetch_score_async = _in_thread(fetch_score)
+fetch_ccmz_async = _in_thread(fetch_ccmz)
+fetch_image_list_async = _in_thread(fetch_image_list)
+fetch_images_async = _in_thread(fetch_images)
+to_midi_bytes_async = _in_thread(to_midi_bytes)
+to_npz_bytes_async = _in_thread(to_npz_bytes)
+render_pdf_bytes_async = _in_thread(render_pdf_bytes)
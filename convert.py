@@ -0,0 +1,71 @@
+import os
+import time
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+import metrics
+from ccmz import LibCCMZ
+
+def find_ccmz(root):
+    """递归查找root下的.ccmz文件, 返回相对路径列表"""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith('.ccmz'):
+                found.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return found
+
+def convert_file(src, dst, npz=False, roll_step=None):
+    """把一个ccmz文件转换为midi文件, npz为True时同时写出同名.npz, 不需要网络"""
+    os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+    with LibCCMZ.open_ccmz_file(src) as info:
+        LibCCMZ.export(info, dst, os.path.splitext(dst)[0] + '.npz' if npz else None, roll_step)
+    return dst
+
+def _convert_task(task, profiler=None):
+    # 进程池的任务函数, 异常转成字符串返回, 不中断其它文件
+    src, dst, collect_metrics, npz, roll_step = task
+    m = metrics.Metrics(src) if collect_metrics else metrics.NULL
+    error = None
+    with metrics.scope(m):
+        try:
+            with m.stage('total'):
+                metrics.call(profiler, convert_file, src, dst, npz, roll_step)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    return src, dst, error, m.to_dict() if m.enabled else None
+
+def convert_directory(src_root, dst_root, workers=None, chunksize=8, npz=False, roll_step=None,
+                      collect_metrics=False, profiler=None, log=print):
+    """离线批量转换: src_root下的ccmz按相同目录结构转换到dst_root, 返回每个文件的结果
+
+    workers为1时在当前进程里转换, 这时profiler才能分析到转换本身。
+    """
+    files = find_ccmz(src_root)
+    tasks = [(os.path.join(src_root, rel), os.path.join(dst_root, os.path.splitext(rel)[0] + '.mid'),
+              collect_metrics, npz, roll_step)
+             for rel in files]
+    total = len(tasks)
+    results = []
+    if not total:
+        log("没有找到ccmz文件")
+        return results
+
+    start = time.perf_counter()
+    step = max(1, total // 100)
+    with ExitStack() as stack:
+        if workers == 1:
+            done = (_convert_task(task, profiler) for task in tasks)
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            done = pool.map(_convert_task, tasks, chunksize=chunksize)
+        for n, (src, dst, error, task_metrics) in enumerate(done, 1):
+            result = {'input': src, 'output': dst, 'ok': error is None, 'error': error}
+            if task_metrics is not None:
+                result['metrics'] = task_metrics
+            results.append(result)
+            if error is not None:
+                log(f"[{n}/{total}] {src}: 失败 {error}")
+            elif n % step == 0 or n == total:
+                log(f"[{n}/{total}] 已转换, {n / (time.perf_counter() - start):.1f}个/秒")
+    return results
@@ -0,0 +1,181 @@
+import io
+import os
+import threading
+import multiprocessing
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import metrics
+
+COLORS = ('keep', 'gray', 'bw')
+PDF_FORMATS = ('flate', 'jpeg')
+
+ImageOptions = namedtuple('ImageOptions', 'color optimize pdf_format quality threshold',
+                          defaults=('keep', False, 'flate', 85, 160))
+
+def convert_image(data, color='keep', fmt='png', optimize=False, quality=85, threshold=160, pdf=False):
+    """重新编码一页曲谱图片(需要PIL), 返回新的图片内容
+
+    color: keep保持原样, gray转灰度, bw按threshold二值化(曲谱只有黑白, 体积最小)。
+    fmt: png或jpeg。optimize为True时png用最高压缩, 不损失画质。
+    pdf为True时二值图保存为只有0/255的灰度图, reportlab不能直接嵌入1位图。
+    """
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        img.load()
+    if img.mode in ('RGBA', 'LA', 'PA') or (img.mode == 'P' and 'transparency' in img.info):
+        # 透明背景按白纸处理, 否则转灰度/jpeg后会变成黑底
+        rgba = img.convert('RGBA')
+        img = Image.new('RGB', rgba.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba.getchannel('A'))
+    if color == 'gray':
+        img = img.convert('L')
+    elif color == 'bw':
+        img = img.convert('L').point(lambda v: 255 if v >= threshold else 0)
+        if not pdf and fmt == 'png':
+            img = img.convert('1', dither=Image.NONE)
+    elif fmt == 'jpeg' and img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+
+    out = io.BytesIO()
+    if fmt == 'jpeg':
+        img.save(out, 'JPEG', quality=quality, optimize=True)
+    else:
+        img.save(out, 'PNG', optimize=optimize, compress_level=9 if optimize else 6)
+    return out.getvalue()
+
+def pdf_image_size(data):
+    """图片嵌入pdf后的流大小(需要reportlab和PIL), 除jpeg外reportlab会解码像素后重新压缩"""
+    from reportlab import rl_config
+    from reportlab.pdfbase.pdfdoc import PDFImageXObject
+    from reportlab.lib.utils import ImageReader
+
+    # 和render_pdf一样不用ASCII85编码
+    rl_config.useA85 = 0
+    image = PDFImageXObject('page')
+    image.loadImageFromSRC(ImageReader(io.BytesIO(data)))
+    return len(image.streamContent)
+
+def _convert_task(args):
+    # 进程池的任务函数, 返回(新图片, (处理前, 处理后)字节数, 错误); 出错时调用方改用原图
+    # pdf的字节数按嵌入pdf后的大小算, 保存的png图片本身不是pdf里的内容
+    data, kwargs = args
+    before = None
+    try:
+        before = pdf_image_size(data) if kwargs['pdf'] else len(data)
+        converted = convert_image(data, **kwargs)
+        after = pdf_image_size(converted) if kwargs['pdf'] else len(converted)
+        return converted, (before, after), None
+    except Exception as e:
+        return None, (before, before) if before is not None else None, f"{type(e).__name__}: {e}"
+
+def _mp_context():
+    # 下载线程运行时直接fork, 子进程可能继承被锁住的连接池/sqlite锁; forkserver从单线程的服务进程fork
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context()
+
+class ImagePipeline:
+    """在进程池里处理曲谱图片, 按页序产出结果, 并统计处理前后的字节数
+
+    同一个ImagePipeline可以被多个线程同时使用, 进程池在第一次用到时才创建。
+    工作进程由forkserver(不支持时用平台默认方式)启动, 不会在其它线程持有锁时fork当前进程。
+    """
+
+    def __init__(self, options=None, workers=None):
+        self.options = options or ImageOptions()
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def enabled(self, target):
+        """target为png(保存的图片)或pdf(嵌入pdf的图片)"""
+        o = self.options
+        if target == 'pdf':
+            return o.color != 'keep' or o.pdf_format == 'jpeg'
+        return o.color != 'keep' or o.optimize
+
+    def describe(self):
+        return dict(self.options._asdict())
+
+    def _kwargs(self, target):
+        o = self.options
+        fmt = o.pdf_format.replace('flate', 'png') if target == 'pdf' else 'png'
+        return {'color': o.color, 'fmt': fmt, 'optimize': o.optimize, 'quality': o.quality,
+                'threshold': o.threshold, 'pdf': target == 'pdf'}
+
+    def start(self):
+        """创建进程池, 工作进程在第一次提交任务时才启动"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_mp_context())
+            return self._pool
+
+    def _count(self, target, before, after, failed=False):
+        m = metrics.current()
+        m.add('images.bytes_in', before)
+        m.add('images.bytes_out', after)
+        with self._lock:
+            item = self._stats.setdefault(target, {'pages': 0, 'bytes_in': 0, 'bytes_out': 0, 'failed': 0})
+            item['pages'] += 1
+            item['bytes_in'] += before
+            item['bytes_out'] += after
+            item['failed'] += failed
+
+    def process(self, pages, target, log=print):
+        """处理按页序产出的(页码, 内容, 错误), 同样按页序产出; 处理失败的页面保留原图"""
+        if not self.enabled(target):
+            yield from pages
+            return
+        pool = self.start()
+        kwargs = self._kwargs(target)
+        lossless = self.options.color == 'keep' and kwargs['fmt'] == 'png'
+        pending = deque()
+
+        def finish(i, content, future):
+            converted, sizes, error = future.result()
+            if error is not None:
+                log(f"第{i}页图片处理失败, 使用原图: {error}")
+                converted = content
+            elif lossless and len(converted) >= len(content):
+                # 无损压缩没有变小, 保留原图
+                converted = content
+                sizes = (sizes[0], sizes[0])
+            self._count(target, *(sizes or (0, 0)), error is not None)
+            return i, converted, None
+
+        for i, content, error in pages:
+            if error is not None:
+                while pending:
+                    yield finish(*pending.popleft())
+                yield i, content, error
+                continue
+            pending.append((i, content, pool.submit(_convert_task, (content, kwargs))))
+            # 最多同时处理workers*2页, 控制内存
+            if len(pending) >= self.workers * 2:
+                yield finish(*pending.popleft())
+        while pending:
+            yield finish(*pending.popleft())
+
+    def stats(self):
+        with self._lock:
+            return {target: dict(item) for target, item in self._stats.items()}
+
+    def summary(self):
+        """每个处理过图片的目标一行节省情况, png按保存的文件算, pdf按嵌入pdf的图片算"""
+        lines = []
+        for target, s in self.stats().items():
+            before, after = s['bytes_in'], s['bytes_out']
+            if not before:
+                continue
+            label = 'PNG图片' if target == 'png' else 'PDF内嵌图片'
+            lines.append(f"{label}处理: {s['pages']}页, {before / 1048576:.2f}MB -> {after / 1048576:.2f}MB, "
+                         f"节省{(before - after) / 1048576:.2f}MB ({(before - after) * 100 / before:.1f}%)")
+        return lines
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
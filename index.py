@@ -0,0 +1,67 @@
+import os
+import time
+import sqlite3
+import threading
+
+FIELDS = ('name', 'typename', 'is_pay', 'play_json')
+
+class ScoreIndex:
+    """music_id -> opern_id及基本信息的本地索引, 正常下载时顺便写入"""
+
+    def __init__(self, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS scores (
+                music_id TEXT PRIMARY KEY,
+                opern_id TEXT NOT NULL,
+                name TEXT,
+                typename TEXT,
+                is_pay TEXT,
+                play_json TEXT,
+                updated REAL
+            )''')
+
+    def _row(self, row):
+        return dict(zip(('music_id', 'opern_id') + FIELDS + ('updated',), row))
+
+    def get(self, music_id):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM scores WHERE music_id = ?',
+                                     (str(music_id),)).fetchone()
+        return self._row(row) if row else None
+
+    def get_many(self, music_ids):
+        """批量查询, 返回{music_id: 记录}, 不在索引中的id不出现在结果里"""
+        ids = list(dict.fromkeys(str(i) for i in music_ids))
+        found = {}
+        with self._lock:
+            # sqlite单条语句的参数个数有限制
+            for pos in range(0, len(ids), 500):
+                chunk = ids[pos:pos + 500]
+                marks = ','.join('?' * len(chunk))
+                for row in self._conn.execute(f'SELECT * FROM scores WHERE music_id IN ({marks})', chunk):
+                    found[row[0]] = self._row(row)
+        return found
+
+    def put(self, music_id, opern_id, details=None):
+        """写入或更新一条记录, 不传details时保留已有的基本信息"""
+        values = [details.get(f) if details else None for f in FIELDS]
+        with self._lock, self._conn:
+            self._conn.execute('''INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(music_id) DO UPDATE SET
+                    opern_id = excluded.opern_id,
+                    name = COALESCE(excluded.name, name),
+                    typename = COALESCE(excluded.typename, typename),
+                    is_pay = COALESCE(excluded.is_pay, is_pay),
+                    play_json = COALESCE(excluded.play_json, play_json),
+                    updated = excluded.updated''',
+                (str(music_id), str(opern_id), *values, time.time()))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,184 +1,401 @@
-import re
 import os
 import sys
 import json
+import time
 import argparse
-import requests
+import metrics
+import transport
+import ratelimit
+import client
+from client import ScoreError, get_music_id, details_url, pdf_info_url, iter_images, render_pdf
+from cache import ResponseCache, default_cache_dir
+from index import ScoreIndex
 from ccmz import LibCCMZ
-
-def httpget(url, headers=None):
-    resp = requests.get(url, headers=headers)
-    resp.raise_for_status()
-    return resp.text
+from convert import convert_directory
+from manifest import Manifest
+from images import ImagePipeline, ImageOptions, COLORS, PDF_FORMATS
 
 def boolean_string(val, detailed=False):
     return "是" if val else "否" if not detailed else ("✔️" if val else "❌")
 
-def get_music_id(param):
-    match = re.search(r'(\d+)', param)
-    return match.group(1) if match else None
-
-def get_opern_id(music_id):
-    url = f"https://www.gangqinpu.com/cchtml/{music_id}.htm"
-    text = httpget(url)
-    match = re.search(r'data-oid="(\d+)"', text)
-    if not match:
-        print("OpernID找不到")
-        return None
-    return match.group(1)
-
-def get_details(opern_id):
-    api = 'https://gangqinpu.lzjoy.com?'
-    params = f"urlparam=pad/detail/operninfov002&old_id={opern_id}"
-    return httpget(api + params)
+def unchanged_output(url, path):
+    """增量同步时, url的内容与上次相同且输出文件还在"""
+    sources = transport.current_sources()
+    return sources is not None and sources.unchanged(url) and os.path.exists(path)
 
-def get_pdf_info(music_id):
-    url = f"https://gangqinpu.lzjoy.com/?urlparam=home/user/getOpernDetail&id={music_id}"
-    response = httpget(url)
-    data = json.loads(response)
-    
-    if data.get('returnMsg') != 'ok':
-        return None
-    
-    return data.get('list', {})
-
-def download_pdf_images(image_list, save_dir, file_name_base):
-    import tempfile
-    from reportlab.pdfgen import canvas
-    from reportlab.lib.pagesizes import A4
-    from PIL import Image
-    
-    image_paths = []
-    
-    with tempfile.TemporaryDirectory() as temp_dir:
-        for i, img_url in enumerate(image_list, 1):
-            try:
-                resp = requests.get(img_url)
-                resp.raise_for_status()
-                
-                img_path = os.path.join(temp_dir, f"temp_{i}.png")
-                with open(img_path, 'wb') as f:
-                    f.write(resp.content)
-                image_paths.append(img_path)
-                
-            except:
-                pass
-        
-        if image_paths:
-            pdf_path = os.path.join(save_dir, f"{file_name_base}.pdf")
-            c = canvas.Canvas(pdf_path, pagesize=A4)
-            
-            for img_path in image_paths:
-                try:
-                    img = Image.open(img_path)
-                    img_width, img_height = img.size
-                    
-                    page_width, page_height = A4
-                    scale_x = page_width / img_width
-                    scale_y = page_height / img_height
-                    scale = min(scale_x, scale_y)
-                    
-                    new_width = img_width * scale
-                    new_height = img_height * scale
-                    x = (page_width - new_width) / 2
-                    y = (page_height - new_height) / 2
-                    
-                    c.drawImage(img_path, x, y, new_width, new_height)
-                    c.showPage()
-                    
-                except:
-                    pass
-            
-            c.save()
-            print(f"PDF已保存: {pdf_path}")
+def download_pdf_images(image_list, save_dir, file_name_base, workers=8, images=None, log=print):
+    pdf_path = os.path.join(save_dir, f"{file_name_base}.pdf")
+    pages = iter_images(image_list, workers)
+    if transport.current_sources() is not None and os.path.exists(pdf_path):
+        # 增量同步: 先下载完所有页面, 都没变时不重新生成pdf
+        pages = list(pages)
+        if all(unchanged_output(url, pdf_path) for url in image_list):
+            log(f"PDF未变化: {pdf_path}")
             return True
-    
+        pages = iter(pages)
+    if images is not None:
+        pages = images.process(pages, 'pdf', log=log)
+    if render_pdf(pages, pdf_path, log=log):
+        log(f"PDF已保存: {pdf_path}")
+        return True
     return False
 
-def download_png_images(image_list, save_dir, file_name_base):
+def download_png_images(image_list, save_dir, file_name_base, workers=8, images=None, log=print):
+    pages = iter_images(image_list, workers)
+    if images is not None:
+        pages = images.process(pages, 'png', log=log)
     success_count = 0
-    for i, img_url in enumerate(image_list, 1):
-        try:
-            resp = requests.get(img_url)
-            resp.raise_for_status()
-            
-            img_path = os.path.join(save_dir, f"{file_name_base}-{i}.png")
+    for i, content, error in pages:
+        if error is not None:
+            log(f"第{i}页下载失败: {error}")
+            continue
+        img_path = os.path.join(save_dir, f"{file_name_base}-{i}.png")
+        if not unchanged_output(image_list[i - 1], img_path):
             with open(img_path, 'wb') as f:
-                f.write(resp.content)
-            success_count += 1
-            
-        except:
-            pass
+                f.write(content)
+        success_count += 1
     
     return success_count
 
-def safe_filename(name):
-    return ''.join(c if c not in '/\\:*?"<>|' else ' ' for c in name)
+def save_midi_streamed(ccmz_link, midi_path, npz_path=None, roll_step=None):
+    """ccmz边下载边解混淆写到临时文件, 再通过mmap读取; 增量同步时内容没变则不写, 返回False"""
+    import tempfile
+    fd, tmp = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    try:
+        with metrics.current().stage('ccmz_download'):
+            ver = LibCCMZ.download_ccmz_to(ccmz_link, tmp)
+        if all(unchanged_output(ccmz_link, p) for p in (midi_path, npz_path) if p):
+            return False
+        with LibCCMZ.open_ccmz_file(tmp, ver) as info:
+            LibCCMZ.export(info, midi_path, npz_path, roll_step)
+        return True
+    finally:
+        os.remove(tmp)
+
+def process_score(input_param, save_dir, pdf=False, png=False, page_workers=8, stream=False,
+                  npz=False, roll_step=None, images=None, index=None, opern_id=None, log=print):
+    m = metrics.current()
+    score = client.fetch_score(input_param, index=index, opern_id=opern_id)
+    os.makedirs(save_dir, exist_ok=True)
+    details = score.details
+    file_name = score.file_name
+
+    log(f"付费歌曲: {boolean_string(details['is_pay'] == '1')}")
+    log(f"音乐名: {details['name']}")
+    log(f"原作者: {details['typename']}")
+    log(f"上传人: {details['author']}")
+
+    outputs = []
+    if png or pdf:
+        image_list = client.fetch_image_list(score)
+        if image_list:
+            log(f"曲谱页数: {len(image_list)}页")
+            if png:
+                with m.stage('png'):
+                    success_count = download_png_images(image_list, save_dir, file_name,
+                                                        workers=page_workers, images=images, log=log)
+                if success_count > 0:
+                    log(f"PNG已保存: {success_count}张图片")
+                if success_count < len(image_list):
+                    raise ScoreError(f"PNG缺页: {len(image_list) - success_count}页下载失败")
+                outputs.extend(os.path.join(save_dir, f"{file_name}-{i}.png")
+                               for i in range(1, len(image_list) + 1))
+            if pdf:
+                with m.stage('pdf'):
+                    ok = download_pdf_images(image_list, save_dir, file_name,
+                                             workers=page_workers, images=images, log=log)
+                if not ok:
+                    raise ScoreError("PDF生成失败")
+                outputs.append(os.path.join(save_dir, f"{file_name}.pdf"))
+        else:
+            log('无曲谱图片可下载')
+
+    if not pdf and not png:
+        if not score.ccmz_url:
+            raise ScoreError('无MIDI可下载')
+        midi_path = os.path.join(save_dir, f"{file_name}.mid")
+        npz_path = os.path.join(save_dir, f"{file_name}.npz") if npz else None
+        if stream:
+            written = save_midi_streamed(score.ccmz_url, midi_path, npz_path, roll_step)
+        else:
+            ccmz_raw = client.fetch_ccmz(score)
+            written = not all(unchanged_output(score.ccmz_url, p) for p in (midi_path, npz_path) if p)
+            if written:
+                LibCCMZ.export(LibCCMZ.open_ccmz(ccmz_raw), midi_path, npz_path, roll_step)
+        log(f"下载成功! 已保存MIDI文件：{midi_path}" if written else f"MIDI未变化: {midi_path}")
+        outputs.append(midi_path)
+        if npz_path:
+            if written:
+                log(f"已保存音符数组：{npz_path}")
+            outputs.append(npz_path)
+
+    return {'id': score.music_id, 'opern_id': score.opern_id, 'name': score.name, 'outputs': outputs}
+
+def sync_score(input_param, save_dir, manifest, pdf=False, png=False, page_workers=8, stream=False,
+               npz=False, roll_step=None, images=None, index=None, opern_id=None, log=print):
+    """增量同步一个琴谱
+
+    清单里有记录且输出文件都在时, 只对详情(和图片列表)发条件请求, 没变化就跳过;
+    有变化时重新处理, 其中内容没变的ccmz和图片不再解码和写入。
+    """
+    music_id = get_music_id(input_param)
+    if not music_id:
+        raise ScoreError("无法识别id")
+    entry = manifest.get(music_id) or {}
+    mode = {'pdf': pdf, 'png': png}
+    if npz:
+        mode.update(npz=True, roll_step=roll_step)
+    if images is not None and ((png and images.enabled('png')) or (pdf and images.enabled('pdf'))):
+        mode['images'] = images.describe()
+    same_mode = entry.get('mode') == mode
+    # 输出方式变了(比如换了图片处理选项)时旧文件不能沿用, 全部重新生成
+    # 有记录的琴谱需要重新处理时, ccmz、图片等不能直接用缓存, 要先确认没有变化
+    sources = transport.Sources(entry.get('sources') if same_mode else None, refresh=bool(entry))
+    with transport.track_sources(sources):
+        if same_mode and manifest.outputs_exist(entry):
+            checks = [(details_url(entry['opern_id']), 'details')]
+            if pdf or png:
+                checks.append((pdf_info_url(music_id), 'pdfinfo'))
+            with metrics.current().stage('revalidate'):
+                changed = any(transport.revalidate(url, kind=kind) is not None for url, kind in checks)
+            if not changed:
+                log("未变化, 跳过")
+                entry['sources'].update(sources.current)
+                manifest.put(music_id, entry)
+                return {'id': music_id, 'opern_id': entry['opern_id'], 'name': entry['name'], 'skipped': True,
+                        'outputs': [os.path.join(save_dir, p) for p in entry['outputs']]}
+        result = process_score(input_param, save_dir, pdf=pdf, png=png, page_workers=page_workers,
+                               stream=stream, npz=npz, roll_step=roll_step, images=images, index=index,
+                               opern_id=opern_id or entry.get('opern_id'), log=log)
+    manifest.put(music_id, {
+        'opern_id': result['opern_id'],
+        'name': result['name'],
+        'mode': mode,
+        'sources': sources.current,
+        'outputs': [manifest.relpath(p) for p in result['outputs']],
+    })
+    return result
+
+def read_id_list(path):
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def run_score(param, save_dir, collect_metrics=False, profiler=None, manifest=None, log=print, **options):
+    """处理一个琴谱并返回结果字典, 异常记录在结果里而不抛出; 传入manifest时增量同步"""
+    m = metrics.Metrics(param) if collect_metrics else metrics.NULL
+    with metrics.scope(m):
+        try:
+            with m.stage('total'):
+                if manifest is None:
+                    result = metrics.call(profiler, process_score, param, save_dir, log=log, **options)
+                else:
+                    result = metrics.call(profiler, sync_score, param, save_dir, manifest, log=log, **options)
+            result['ok'] = True
+        except Exception as e:
+            result = {'id': get_music_id(param) or param, 'ok': False, 'error': str(e)}
+    result['input'] = param
+    if m.enabled:
+        result['metrics'] = m.to_dict()
+    return result
+
+def run_batch(params, save_dir, jobs=4, index=None, **options):
+    """并发处理多个琴谱, 单个失败不影响其它, 返回每个id的结果"""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    known = {}
+    if index is not None:
+        known = index.get_many(filter(None, map(get_music_id, params)))
+
+    def task(param):
+        def log(msg):
+            print(f"[{param}] {msg}")
+        row = known.get(get_music_id(param))
+        result = run_score(param, save_dir, index=index,
+                           opern_id=row and row['opern_id'], log=log, **options)
+        if not result['ok']:
+            log(f"失败: {result['error']}")
+        return result
+
+    results = []
+    total = len(params)
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = [pool.submit(task, p) for p in params]
+        for n, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            results.append(result)
+            status = '失败' if not result['ok'] else '未变化' if result.get('skipped') else '成功'
+            print(f"[{n}/{total}] {result['input']}: {status}")
+    return results
+
+def finish(results, report=None):
+    """汇总输出批量结果, 有失败时以1退出"""
+    failed = [r for r in results if not r['ok']]
+    skipped = sum(1 for r in results if r.get('skipped'))
+    print(f"完成: 成功{len(results) - len(failed)}个, 失败{len(failed)}个"
+          + (f", 其中{skipped}个未变化" if skipped else ''))
+    for r in failed:
+        print(f"  {r['input']}: {r['error']}")
+    if report:
+        with open(report, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if failed:
+        sys.exit(1)
+
+def write_metrics(path, results, elapsed):
+    """每个琴谱一份指标, 再加上整次运行的汇总"""
+    totals = metrics.Metrics()
+    for r in results:
+        totals.merge(r.get('metrics', {}))
+    summary = {
+        'elapsed': elapsed and round(elapsed, 6),
+        'count': len(results),
+        'failed': sum(1 for r in results if not r['ok']),
+        'totals': totals.to_dict(),
+        'transport': transport.get_transport().stats(),
+        'scores': [{'input': r['input'], 'ok': r['ok'], **r.get('metrics', {})} for r in results],
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
 
 def main():
     parser = argparse.ArgumentParser(description="虫虫钢琴钢琴谱midi下载")
-    parser.add_argument('-i', '--id', required=True, help='琴谱id或url')
+    parser.add_argument('-i', '--id', nargs='+', default=[], help='琴谱id或url, 可指定多个')
+    parser.add_argument('-f', '--file', help='从文件批量读取id或url, 每行一个, "-"表示标准输入')
+    parser.add_argument('-c', '--convert', metavar='DIR', help='离线转换: 把目录下所有.ccmz转换为midi, 不联网')
+    parser.add_argument('-j', '--jobs', type=int, help='批量模式并发数（默认4, 离线转换默认CPU核数）')
+    parser.add_argument('--report', help='批量模式结果保存为json文件')
     parser.add_argument('-o', '--output', default='./output', help='保存目录（默认output）')
     parser.add_argument('-pdf', action='store_true', help='下载曲谱为pdf格式')
     parser.add_argument('-png', action='store_true', help='下载曲谱为png格式')
+    parser.add_argument('--stream', action='store_true', help='ccmz流式下载到临时文件再解码, 减少内存占用')
+    parser.add_argument('--npz', action='store_true', help='同时把音符保存为numpy的.npz列式数组')
+    parser.add_argument('--piano-roll', type=int, metavar='TICKS',
+                        help='npz中附带钢琴卷帘矩阵, 每列TICKS个tick（480为一拍）')
+    parser.add_argument('--color', choices=COLORS, default='keep',
+                        help='曲谱图片颜色: keep不变, gray灰度, bw黑白二值（体积最小）')
+    parser.add_argument('--optimize-png', action='store_true', help='无损优化保存的png图片')
+    parser.add_argument('--pdf-image', choices=PDF_FORMATS, default='flate',
+                        help='pdf中图片的压缩方式: flate无损, jpeg有损（默认flate）')
+    parser.add_argument('--jpeg-quality', type=int, default=85, help='--pdf-image jpeg时的质量（默认85）')
+    parser.add_argument('--image-workers', type=int, help='处理图片的进程数（默认CPU核数）')
+    parser.add_argument('--page-workers', type=int, default=8, help='每个琴谱同时下载的图片数（默认8）')
+    parser.add_argument('--cache-dir', default=os.path.join(default_cache_dir(), 'responses'), help='响应缓存目录')
+    parser.add_argument('--cache-size', type=int, default=1024, help='缓存大小上限MB（默认1024）')
+    parser.add_argument('--no-cache', action='store_true', help='不使用缓存')
+    parser.add_argument('--index', default=os.path.join(default_cache_dir(), 'index.sqlite'),
+                        help='music_id到OpernID的本地索引文件')
+    parser.add_argument('--no-index', action='store_true', help='不使用本地索引')
+    parser.add_argument('--timeout', type=float, default=30, help='网络请求超时秒数（默认30）')
+    parser.add_argument('--retries', type=int, default=3, help='失败重试次数（默认3）')
+    parser.add_argument('--rate', type=float, default=ratelimit.DEFAULT_RATE,
+                        help=f'每个主机每秒最多请求数, 0不限（默认{ratelimit.DEFAULT_RATE}）')
+    parser.add_argument('--max-concurrency', type=int, default=ratelimit.DEFAULT_CONCURRENCY,
+                        help=f'每个主机的最大并发请求数, 遇到限流或变慢时自动降低, 0不限（默认{ratelimit.DEFAULT_CONCURRENCY}）')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='常驻服务模式: 通过HTTP提供/midi/<id>、/pdf/<id>、/png/<id>/<页码>')
+    parser.add_argument('--host', default='127.0.0.1', help='服务模式监听的地址（默认127.0.0.1）')
+    parser.add_argument('--sync', action='store_true',
+                        help='增量同步: 按输出目录里的manifest.json跳过没有变化的琴谱')
+    parser.add_argument('--metrics', metavar='PATH', help='把各阶段耗时、流量和计数写成json文件')
+    parser.add_argument('--profile', metavar='PATH', help='用cProfile分析, 结果保存为pstats文件')
     args = parser.parse_args()
 
-    input_param = args.id
+    profiler = metrics.Profiler() if args.profile else None
+    collect_metrics = bool(args.metrics)
+    images = ImagePipeline(ImageOptions(args.color, args.optimize_png, args.pdf_image, args.jpeg_quality),
+                           workers=args.image_workers)
+    if not (args.png and images.enabled('png')) and not (args.pdf and images.enabled('pdf')):
+        images = None
+    start = time.perf_counter()
+    try:
+        results = run(parser, args, collect_metrics, profiler, images)
+    finally:
+        if profiler is not None:
+            profiler.dump(args.profile)
+        if images is not None:
+            images.close()
+            for line in images.summary():
+                print(line)
+    if args.metrics and results is not None:
+        write_metrics(args.metrics, results, time.perf_counter() - start)
+    if results is not None:
+        finish(results, args.report)
+
+def run(parser, args, collect_metrics=False, profiler=None, images=None):
+    if args.piano_roll and not args.npz:
+        parser.error('--piano-roll 需要与 --npz 一起使用')
+    if args.convert:
+        return convert_directory(args.convert, args.output, workers=args.jobs, npz=args.npz,
+                                 roll_step=args.piano_roll, collect_metrics=collect_metrics,
+                                 profiler=profiler)
+
+    jobs = args.jobs or 4
+    if profiler is not None and profiler.exclusive and jobs > 1:
+        print("Python 3.12及以上同时只能分析一个线程, 使用 --profile 时改为 -j 1")
+        jobs = 1
+    params = list(args.id)
+    if args.file:
+        params.extend(read_id_list(args.file))
+    params = list(dict.fromkeys(params))
+    if not params and args.serve is None:
+        parser.error('需要指定 -i 或 -f')
+
     save_dir = args.output
-    music_id = get_music_id(input_param)
-    if not music_id:
-        print("无法识别id")
-        sys.exit(1)
+    cache = None
+    if not args.no_cache:
+        cache = ResponseCache(args.cache_dir, max_bytes=args.cache_size << 20)
+    transport.configure(timeout=(min(args.timeout, 10), args.timeout), retries=args.retries,
+                        pool_maxsize=max(16, jobs * 2, args.page_workers * 2), cache=cache,
+                        limiter=ratelimit.RateLimiter(args.rate, args.max_concurrency))
+    index = None if args.no_index else ScoreIndex(args.index)
 
-    os.makedirs(save_dir, exist_ok=True)
+    if args.serve is not None:
+        from server import serve
+        serve(args.host, args.serve, index=index, page_workers=args.page_workers)
+        return None
+    manifest = Manifest(save_dir) if args.sync else None
+    score_options = {'pdf': args.pdf, 'png': args.png, 'page_workers': args.page_workers,
+                     'stream': args.stream, 'npz': args.npz, 'roll_step': args.piano_roll, 'images': images}
+    options = dict(score_options, collect_metrics=collect_metrics, profiler=profiler, manifest=manifest)
 
-    opern_id = get_opern_id(music_id)
-    if not opern_id:
-        print("无法获取OpernID，退出。")
-        sys.exit(1)
-    details = json.loads(get_details(opern_id))['list']
-    #print(details)
-    ccmz_link = details['play_json']
-    music_name = details['name']
-    paid = details['is_pay']
-    typename = details['typename']
-    authorc_name = details['author']
-
-    file_name = f"{safe_filename(music_name)}-{safe_filename(typename)}"
-
-    print(f"付费歌曲: {boolean_string(paid == '1')}")
-    print(f"音乐名: {music_name}")
-    print(f"原作者: {typename}")
-    print(f"上传人: {authorc_name}")
-
-    if args.png:
-        pdf_info = get_pdf_info(music_id)
-        if pdf_info and 'image_list' in pdf_info:
-            image_list = pdf_info['image_list']
-            print(f"曲谱页数: {len(image_list)}页")
-            success_count = download_png_images(image_list, save_dir, file_name)
-            if success_count > 0:
-                print(f"PNG已保存: {success_count}张图片")
-        else:
-            print('无曲谱图片可下载')
-
-    if not args.pdf and not args.png:
-        ccmz_link = details['play_json']
-        if ccmz_link:
-            ccmz_raw = LibCCMZ.download_ccmz(ccmz_link)
-            def cb(info):
-                midi_path = os.path.join(save_dir, f"{file_name}.mid")
-                if info.ver == 2:
-                    midi_data = json.loads(info.midi)
-                    LibCCMZ.write_midi(midi_data, midi_path)
-                else:
-                    with open(midi_path, "wb") as f:
-                        f.write(info.midi.encode("latin1"))
-                print(f"下载成功! 已保存MIDI文件：{midi_path}")
-            LibCCMZ.read_ccmz(ccmz_raw, cb)
-        else:
-            print('无MIDI可下载')
+    if len(params) == 1 and not args.file:
+        func, extra = (process_score, ()) if manifest is None else (sync_score, (manifest,))
+        m = metrics.Metrics(params[0]) if collect_metrics else metrics.NULL
+        start = time.perf_counter()
+        try:
+            with metrics.scope(m), m.stage('total'):
+                result = metrics.call(profiler, func, params[0], save_dir, *extra, index=index,
+                                      **score_options)
+        except ScoreError as e:
+            print(f"{e}，退出。")
+            sys.exit(1)
+        finally:
+            if manifest is not None:
+                manifest.save()
+        if collect_metrics:
+            result.update(ok=True, input=params[0], metrics=m.to_dict())
+            write_metrics(args.metrics, [result], time.perf_counter() - start)
+        return None
+
+    try:
+        results = run_batch(params, save_dir, jobs=jobs, index=index, **options)
+    finally:
+        if manifest is not None:
+            manifest.save()
+    if cache is not None:
+        kinds = cache.stats()['kinds'].values()
+        print(f"缓存: 命中{sum(k['hits'] for k in kinds)}次, 未命中{sum(k['misses'] for k in kinds)}次")
+    for line in transport.get_transport().limiter.summary():
+        print(line)
+    return results
 
 if __name__ == "__main__":
     main()
-    
\ No newline at end of file
@@ -0,0 +1,65 @@
+import os
+import json
+import time
+import tempfile
+import threading
+
+MANIFEST_NAME = 'manifest.json'
+
+class Manifest:
+    """增量同步清单, 保存在输出目录里
+
+    每个music_id记录: OpernID、输出方式、用到的url及其ETag/Last-Modified和sha256、生成的文件。
+    输出文件路径相对于输出目录保存, 整个目录移动后仍然有效。
+    """
+
+    def __init__(self, save_dir, name=MANIFEST_NAME, flush_every=50):
+        self.root = save_dir
+        self.path = os.path.join(save_dir, name)
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._dirty = 0
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self._scores = json.load(f).get('scores', {})
+        except FileNotFoundError:
+            self._scores = {}
+
+    def get(self, music_id):
+        with self._lock:
+            entry = self._scores.get(str(music_id))
+        return json.loads(json.dumps(entry)) if entry else None
+
+    def put(self, music_id, entry):
+        """写入一条记录, 累计flush_every条后自动保存"""
+        entry = dict(entry, updated=time.time())
+        with self._lock:
+            self._scores[str(music_id)] = entry
+            self._dirty += 1
+            flush = self._dirty >= self.flush_every
+        if flush:
+            self.save()
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.root)
+
+    def outputs_exist(self, entry):
+        return bool(entry.get('outputs')) and all(
+            os.path.exists(os.path.join(self.root, p)) for p in entry['outputs'])
+
+    def save(self):
+        """先写临时文件再替换, 中途中断不会留下损坏的清单"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps({'version': 1, 'scores': self._scores}, ensure_ascii=False, indent=1)
+            self._dirty = 0
+            os.makedirs(self.root, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.manifest-')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
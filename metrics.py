@@ -0,0 +1,167 @@
+import sys
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+class _Stage:
+    __slots__ = ('_metrics', '_name', '_start')
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._metrics.record(self._name, time.perf_counter() - self._start)
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_STAGE = _NullStage()
+
+class Metrics:
+    """各阶段耗时和计数, 线程安全"""
+
+    enabled = True
+
+    def __init__(self, name=None):
+        self.name = name
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+
+    def stage(self, name):
+        """with metrics.stage('details'): ... 记录该阶段的次数和总耗时"""
+        return _Stage(self, name)
+
+    def record(self, name, seconds):
+        with self._lock:
+            item = self._stages.get(name)
+            if item is None:
+                item = self._stages[name] = [0, 0.0]
+            item[0] += 1
+            item[1] += seconds
+
+    def add(self, key, n=1):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def merge(self, other):
+        """把另一个Metrics(或其to_dict结果)累加进来"""
+        data = other.to_dict() if isinstance(other, Metrics) else other
+        with self._lock:
+            for name, item in data.get('stages', {}).items():
+                mine = self._stages.setdefault(name, [0, 0.0])
+                mine[0] += item['count']
+                mine[1] += item['seconds']
+            for key, n in data.get('counters', {}).items():
+                self._counters[key] = self._counters.get(key, 0) + n
+
+    def to_dict(self):
+        with self._lock:
+            data = {
+                'stages': {name: {'count': c, 'seconds': round(t, 6)} for name, (c, t) in self._stages.items()},
+                'counters': dict(self._counters),
+            }
+        if self.name is not None:
+            data['name'] = self.name
+        return data
+
+class _NullMetrics:
+    """未启用时使用, 所有操作都是空操作"""
+
+    enabled = False
+    name = None
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def record(self, name, seconds):
+        pass
+
+    def add(self, key, n=1):
+        pass
+
+    def merge(self, other):
+        pass
+
+    def to_dict(self):
+        return {}
+
+NULL = _NullMetrics()
+
+_current = contextvars.ContextVar('metrics', default=NULL)
+
+def current():
+    """当前线程/上下文正在记录的Metrics, 未启用时为NULL"""
+    return _current.get()
+
+@contextmanager
+def scope(m):
+    """在with块内把m设为当前Metrics"""
+    token = _current.set(m)
+    try:
+        yield m
+    finally:
+        _current.reset(token)
+
+# 3.12起cProfile基于sys.monitoring, 同一进程同时只能有一个profiler
+_EXCLUSIVE = sys.version_info >= (3, 12)
+
+class Profiler:
+    """用cProfile分别记录多个线程里的调用, 最后合并成一个pstats文件
+
+    Python 3.12及以上同时只能运行一个profiler, 各线程的调用会排队依次执行。
+    """
+
+    exclusive = _EXCLUSIVE
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._profiles = []
+
+    def run(self, func, *args, **kwargs):
+        import cProfile
+        profile = cProfile.Profile()
+        if self.exclusive:
+            self._run_lock.acquire()
+        try:
+            # enable()失败(已有其它分析工具)时不记录这个profile, 否则dump时读不出数据
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self._profiles.append(profile)
+        finally:
+            if self.exclusive:
+                self._run_lock.release()
+
+    def dump(self, path):
+        import pstats
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+def call(profiler, func, *args, **kwargs):
+    """profiler为None时直接调用"""
+    if profiler is None:
+        return func(*args, **kwargs)
+    return profiler.run(func, *args, **kwargs)
@@ -0,0 +1,213 @@
+import time
+import threading
+from urllib.parse import urlsplit
+import metrics
+
+DEFAULT_RATE = 20
+DEFAULT_CONCURRENCY = 16
+# 这些状态码说明服务器已经忙不过来或者在限流
+OVERLOAD_STATUS = frozenset([429, 500, 502, 503, 504])
+
+class HostLimit:
+    """一个主机的令牌桶限速和AIMD并发控制
+
+    rate为每秒请求数(0不限), 最多攒burst个令牌; 并发数从initial开始,
+    响应正常时逐渐增加到maximum, 遇到429/5xx/连接错误时减半, 延迟明显上升时减为0.8倍。
+    每个延迟窗口内最多降一次, 一批同时失败的请求只算一次。
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, maximum=DEFAULT_CONCURRENCY, initial=4, burst=None,
+                 latency_factor=2.0):
+        self.max_rate = self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.maximum = maximum
+        self.limit = float(min(initial, maximum)) if maximum else 0.0
+        self.latency_factor = latency_factor
+        self.in_flight = 0
+        self.latency = None
+        self.baseline = None
+        self._tokens = float(self.burst)
+        self._stamp = time.monotonic()
+        self._paused_until = 0.0
+        self._cooldown_until = 0.0
+        self._slow_start = True
+        self._cond = threading.Condition()
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.backoffs = 0
+        self.wait_seconds = 0.0
+
+    def acquire(self):
+        """占用一个并发名额, 返回还需要等待的秒数(令牌不足或服务器要求暂停)"""
+        with self._cond:
+            while self.maximum and self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            self.requests += 1
+            now = time.monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self.rate:
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                # 令牌可以透支, 透支的部分按速率排队
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+            return wait
+
+    def release(self, status=None, latency=None, error=False):
+        with self._cond:
+            self.in_flight -= 1
+            if error or status in OVERLOAD_STATUS:
+                self._penalize(status, error)
+            elif latency is not None:
+                self._observe(latency)
+            self._cond.notify_all()
+
+    def penalize(self, status=None, error=False, retry_after=None):
+        """请求还没结束(正在重试)时报告的429/5xx/连接错误"""
+        with self._cond:
+            self._penalize(status, error, retry_after)
+
+    def _penalize(self, status, error, retry_after=None):
+        now = time.monotonic()
+        if status == 429:
+            self.throttled += 1
+        elif error:
+            self.errors += 1
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+        if now < self._cooldown_until:
+            return
+        self._decrease(now, 0.5)
+        if status == 429 and self.rate:
+            # 被限流时速率也减半, 之后慢慢恢复
+            self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def _observe(self, latency):
+        if self.latency is None:
+            self.latency = self.baseline = latency
+        else:
+            self.latency += (latency - self.latency) * 0.2
+            # 基线取最低延迟, 并缓慢跟随, 服务器整体变慢后不会一直误判
+            if latency < self.baseline:
+                self.baseline = latency
+            else:
+                self.baseline += (latency - self.baseline) * 0.01
+        if self.latency > self.baseline * self.latency_factor and self.latency - self.baseline > 0.05:
+            now = time.monotonic()
+            if now >= self._cooldown_until:
+                self._decrease(now, 0.8)
+            return
+        if self.maximum:
+            # 慢启动: 第一次退避之前每个成功的请求加1, 之后每个窗口加1
+            step = 1.0 if self._slow_start else 1.0 / max(self.limit, 1.0)
+            self.limit = min(float(self.maximum), self.limit + step)
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def _decrease(self, now, factor):
+        self.backoffs += 1
+        self._slow_start = False
+        if self.maximum:
+            self.limit = max(1.0, self.limit * factor)
+        self._cooldown_until = now + max(self.latency or 0.0, 0.2)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'rate': round(self.rate, 3),
+                'concurrency': int(self.limit) if self.maximum else None,
+                'in_flight': self.in_flight,
+                'latency_ms': self.latency and round(self.latency * 1000, 1),
+                'baseline_ms': self.baseline and round(self.baseline * 1000, 1),
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'errors': self.errors,
+                'backoffs': self.backoffs,
+                'wait_seconds': round(self.wait_seconds, 3),
+            }
+
+class _Slot:
+    __slots__ = ('_host', '_status', '_latency')
+
+    def __init__(self, host):
+        self._host = host
+        self._status = None
+        self._latency = None
+
+    def __enter__(self):
+        start = time.monotonic()
+        wait = self._host.acquire()
+        if wait > 0:
+            time.sleep(wait)
+        waited = time.monotonic() - start
+        if waited > 0.001:
+            m = metrics.current()
+            m.add('ratelimit.waits')
+            m.add('ratelimit.wait_seconds', waited)
+            with self._host._cond:
+                self._host.wait_seconds += waited
+        return self
+
+    def done(self, resp):
+        """收到响应头时调用, 按状态码和响应时间调整限制, 返回resp"""
+        self._status = resp.status_code
+        retries = getattr(resp.raw, 'retries', None)
+        if not (retries and retries.history):
+            # 重试过的请求耗时包含退避等待, 不能反映服务器延迟
+            self._latency = resp.elapsed.total_seconds()
+        return resp
+
+    def __exit__(self, exc_type, exc, tb):
+        # 没收到响应就出错(超时、连接失败)也算服务器过载
+        error = exc_type is not None and self._status is None
+        if error or self._status in OVERLOAD_STATUS:
+            metrics.current().add('ratelimit.backoff_signals')
+        self._host.release(self._status, self._latency, error)
+
+class RateLimiter:
+    """按主机分别限速, Transport的每个请求都先经过这里
+
+    rate为每个主机每秒的请求数, max_concurrency为每个主机的并发上限, 都为0时不做限制。
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, max_concurrency=DEFAULT_CONCURRENCY, initial=4,
+                 latency_factor=2.0):
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+        self.initial = initial
+        self.latency_factor = latency_factor
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def host(self, name):
+        with self._lock:
+            limit = self._hosts.get(name)
+            if limit is None:
+                limit = self._hosts[name] = HostLimit(self.rate, self.max_concurrency, self.initial,
+                                                      latency_factor=self.latency_factor)
+            return limit
+
+    def slot(self, url):
+        """with limiter.slot(url) as slot: resp = slot.done(session.get(url))"""
+        return _Slot(self.host(urlsplit(url).hostname))
+
+    def penalize(self, host, status=None, error=False, retry_after=None):
+        self.host(host).penalize(status, error, retry_after)
+
+    def stats(self):
+        with self._lock:
+            hosts = dict(self._hosts)
+        return {name: limit.stats() for name, limit in hosts.items()}
+
+    def summary(self):
+        """发生过退避的主机各一行, 没有时为空列表"""
+        lines = []
+        for name, s in self.stats().items():
+            if s['backoffs']:
+                rate = f"每秒{s['rate']:g}次" if s['rate'] else '速率不限'
+                lines.append(f"限速: {name} 退避{s['backoffs']}次(429共{s['throttled']}次, 连接错误{s['errors']}次), "
+                             f"当前并发{s['concurrency'] or '不限'}, {rate}")
+        return lines
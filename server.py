@@ -0,0 +1,170 @@
+import re
+import json
+import threading
+from concurrent.futures import Future
+from urllib.parse import quote, urlsplit
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import metrics
+import transport
+import client
+from client import ScoreError
+
+ROUTES = (
+    (re.compile(r'^/midi/(\d+)$'), 'midi'),
+    (re.compile(r'^/pdf/(\d+)$'), 'pdf'),
+    (re.compile(r'^/png/(\d+)/(\d+)$'), 'png'),
+)
+CONTENT_TYPES = {'midi': 'audio/midi', 'pdf': 'application/pdf', 'png': 'image/png'}
+
+class SingleFlight:
+    """同一个键同时只执行一次, 期间相同键的调用等待并共享结果"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.collapsed = 0
+
+    def do(self, key, func, *args):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.collapsed += 1
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+class ScoreService:
+    """常驻进程里生成midi/pdf/png, 结果只在内存中, 不写文件
+
+    连接池、响应缓存和索引在请求之间复用, 同一个琴谱的并发请求只做一次。
+    """
+
+    def __init__(self, index=None, page_workers=8):
+        self.index = index
+        self.page_workers = page_workers
+        self.flight = SingleFlight()
+        self.metrics = metrics.Metrics('server')
+        # 没有索引时也记住OpernID, 同一琴谱不再重复抓取页面
+        self._opern_ids = {}
+
+    def score(self, music_id):
+        return self.flight.do(('score', music_id), self._score, music_id)
+
+    def _score(self, music_id):
+        score = client.fetch_score(music_id, index=self.index, opern_id=self._opern_ids.get(music_id))
+        self._opern_ids[music_id] = score.opern_id
+        return score
+
+    def image_list(self, music_id):
+        image_list = client.fetch_image_list(music_id)
+        if not image_list:
+            raise ScoreError('无曲谱图片')
+        return image_list
+
+    def build(self, kind, music_id, page=None):
+        """返回(文件名, 内容)"""
+        with metrics.scope(self.metrics), self.metrics.stage(kind):
+            return self.flight.do((kind, music_id, page), getattr(self, '_' + kind), music_id, page)
+
+    def _midi(self, music_id, page=None):
+        score = self.score(music_id)
+        return f"{score.file_name}.mid", client.to_midi_bytes(client.fetch_ccmz(score))
+
+    def _pdf(self, music_id, page=None):
+        images = client.fetch_images(music_id, self.page_workers)
+        if not images:
+            raise ScoreError('无曲谱图片')
+        return f"{self.score(music_id).file_name}.pdf", client.render_pdf_bytes(images)
+
+    def _png(self, music_id, page):
+        image_list = self.image_list(music_id)
+        if not 1 <= page <= len(image_list):
+            raise ScoreError(f"页码超出范围: 共{len(image_list)}页")
+        return f"{self.score(music_id).file_name}-{page}.png", client.fetch_image(image_list[page - 1])
+
+    def stats(self):
+        return {'service': self.metrics.to_dict(), 'collapsed': self.flight.collapsed,
+                'transport': transport.get_transport().stats()}
+
+def _handler(service, log=print):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            log(f"{self.address_string()} {format % args}")
+
+        def send_body(self, status, ctype, body, headers=()):
+            self.send_response(status)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+
+        def send_error_text(self, status, message):
+            self.send_body(status, 'text/plain; charset=utf-8', message.encode('utf-8'))
+
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            if path == '/stats':
+                body = json.dumps(service.stats(), ensure_ascii=False).encode('utf-8')
+                return self.send_body(200, 'application/json', body)
+            for pattern, kind in ROUTES:
+                match = pattern.match(path)
+                if match:
+                    break
+            else:
+                return self.send_error_text(404, '未知的地址')
+
+            music_id = match.group(1)
+            page = int(match.group(2)) if kind == 'png' else None
+            try:
+                name, body = service.build(kind, music_id, page)
+            except ScoreError as e:
+                return self.send_error_text(404, str(e))
+            except Exception as e:
+                service.metrics.add('errors')
+                return self.send_error_text(502, f"{type(e).__name__}: {e}")
+            disposition = f"inline; filename*=UTF-8''{quote(name)}"
+            self.send_body(200, CONTENT_TYPES[kind], body, [('Content-Disposition', disposition)])
+
+        do_HEAD = do_GET
+
+    return Handler
+
+def _preload():
+    # 提前导入生成pdf用的模块, 第一个请求不用再等
+    try:
+        import reportlab.pdfgen.canvas  # noqa: F401
+        import reportlab.lib.utils  # noqa: F401
+    except ImportError:
+        pass
+
+def serve(host='127.0.0.1', port=8000, index=None, page_workers=8, log=print):
+    """启动服务, 直到Ctrl+C"""
+    _preload()
+    service = ScoreService(index=index, page_workers=page_workers)
+    httpd = ThreadingHTTPServer((host, port), _handler(service, log))
+    httpd.daemon_threads = True
+    log(f"服务已启动: http://{host}:{httpd.server_address[1]}/midi/<id>, /pdf/<id>, /png/<id>/<页码>, /stats")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
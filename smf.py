@@ -0,0 +1,146 @@
+import struct
+
+# 同一tick内的先后顺序: 元事件, 音色, 音符关, 控制器/弯音, 音符开
+ORDER_META = 0
+ORDER_PROGRAM = 1
+ORDER_NOTE_OFF = 2
+ORDER_CONTROL = 3
+ORDER_NOTE_ON = 4
+
+STATUS_ORDER = {0x80: ORDER_NOTE_OFF, 0x90: ORDER_NOTE_ON, 0xC0: ORDER_PROGRAM}
+
+END_OF_TRACK = b'\x00\xff\x2f\x00'
+
+def vlq(value):
+    """编码为MIDI变长整数"""
+    if value < 0x80:
+        return bytes((value,))
+    out = bytearray((value & 0x7F,))
+    value >>= 7
+    while value:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.reverse()
+    return bytes(out)
+
+def read_vlq(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+class SMFWriter:
+    """直接用整数tick写标准MIDI文件(格式1), 第0轨为速度轨"""
+
+    def __init__(self, num_tracks, ticks_per_beat=480):
+        self.ticks_per_beat = ticks_per_beat
+        self.tracks = [[] for _ in range(num_tracks + 1)]
+
+    def _add(self, track, tick, order, data):
+        # midi.json里的tick和时值可能是浮点数, 取最近的整数tick
+        if tick.__class__ is not int:
+            tick = int(round(tick))
+        # 排序键合并成一个整数, 比元组比较快
+        self.tracks[track].append(((tick << 3) | order, data))
+
+    def add_event(self, chunk, tick, data):
+        """按原始字节写入事件, chunk为文件中的轨道序号(0为速度轨)"""
+        order = ORDER_META if data[0] >= 0xF0 else STATUS_ORDER.get(data[0] & 0xF0, ORDER_CONTROL)
+        self._add(chunk, tick, order, bytes(data))
+
+    def add_tempo(self, tick, microseconds_per_beat):
+        """microseconds_per_beat可以是浮点数, 超出3字节范围时取最大值"""
+        tempo = min(max(int(round(microseconds_per_beat)), 1), 0xFFFFFF)
+        self._add(0, tick, ORDER_META, b'\xff\x51\x03' + tempo.to_bytes(3, 'big'))
+
+    def add_track_name(self, track, tick, name):
+        text = name.encode('utf-8')
+        self._add(track + 1, tick, ORDER_META, b'\xff\x03' + vlq(len(text)) + text)
+
+    def add_program_change(self, track, channel, tick, program):
+        self._add(track + 1, tick, ORDER_PROGRAM, bytes((0xC0 | channel, program & 0x7F)))
+
+    def add_note(self, track, channel, pitch, tick, duration, velocity):
+        self._add(track + 1, tick, ORDER_NOTE_ON, bytes((0x90 | channel, pitch & 0x7F, velocity & 0x7F)))
+        self._add(track + 1, tick + duration, ORDER_NOTE_OFF, bytes((0x80 | channel, pitch & 0x7F, 0)))
+
+    def add_controller(self, track, channel, tick, controller, value):
+        self._add(track + 1, tick, ORDER_CONTROL, bytes((0xB0 | channel, controller & 0x7F, value & 0x7F)))
+
+    def add_pitch_bend(self, track, channel, tick, value):
+        """value为0~16383, 8192为不弯音"""
+        self._add(track + 1, tick, ORDER_CONTROL, bytes((0xE0 | channel, value & 0x7F, (value >> 7) & 0x7F)))
+
+    def _encode_track(self, events):
+        events.sort(key=lambda e: e[0])
+        # 预留块头, 写完后回填长度
+        chunk = bytearray(b'MTrk\x00\x00\x00\x00')
+        append = chunk.append
+        extend = chunk.extend
+        prev = 0
+        for key, data in events:
+            tick = key >> 3
+            delta = tick - prev
+            prev = tick
+            if delta < 0x80:
+                append(delta)
+            else:
+                extend(vlq(delta))
+            extend(data)
+        extend(END_OF_TRACK)
+        struct.pack_into('>I', chunk, 4, len(chunk) - 8)
+        return chunk
+
+    def to_bytes(self):
+        out = bytearray(struct.pack('>4sIHHH', b'MThd', 6, 1, len(self.tracks), self.ticks_per_beat))
+        for events in self.tracks:
+            out += self._encode_track(events)
+        return bytes(out)
+
+    def write(self, f):
+        f.write(self.to_bytes())
+
+def read_tracks(data):
+    """解析标准MIDI文件, 返回(ticks_per_beat, [[(绝对tick, 事件字节), ...], ...])"""
+    view = memoryview(data)
+    magic, size, _, ntracks, division = struct.unpack_from('>4sIHHH', view, 0)
+    if magic != b'MThd':
+        raise ValueError("不是标准MIDI文件")
+    pos = 8 + size
+    tracks = []
+    for _ in range(ntracks):
+        magic, size = struct.unpack_from('>4sI', view, pos)
+        pos += 8
+        end = pos + size
+        if magic != b'MTrk':
+            pos = end
+            continue
+        events = []
+        tick = 0
+        status = None
+        while pos < end:
+            delta, pos = read_vlq(view, pos)
+            tick += delta
+            first = view[pos]
+            if first == 0xFF:
+                length, body = read_vlq(view, pos + 2)
+                event_end = body + length
+            elif first in (0xF0, 0xF7):
+                length, body = read_vlq(view, pos + 1)
+                event_end = body + length
+            else:
+                if first & 0x80:
+                    status = first
+                    pos += 1
+                size = 1 if (status & 0xF0) in (0xC0, 0xD0) else 2
+                events.append((tick, bytes((status,)) + bytes(view[pos:pos + size])))
+                pos += size
+                continue
+            events.append((tick, bytes(view[pos:event_end])))
+            pos = event_end
+        tracks.append(events)
+        pos = end
+    return division, tracks
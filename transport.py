@@ -0,0 +1,334 @@
+import hashlib
+import threading
+import contextvars
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import requests
+import metrics
+import ratelimit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_TIMEOUT = (5, 30)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# 服务器要求等待的时间(Retry-After)最多等这么久
+MAX_RETRY_AFTER = 60
+
+class _CountingRetry(Retry):
+    """urllib3每次重试都会new()一个Retry, 这里把计数回调传下去"""
+
+    def __init__(self, *args, on_retry=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_retry = on_retry
+
+    def new(self, **kw):
+        retry = super().new(**kw)
+        retry.on_retry = self.on_retry
+        return retry
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        return retry_after and min(retry_after, MAX_RETRY_AFTER)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        if self.on_retry:
+            self.on_retry(_pool.host if _pool else None, response.status if response else None, error,
+                          self.get_retry_after(response) if response else None)
+        return retry
+
+class Sources:
+    """记录一个琴谱用到的url及其ETag/Last-Modified和内容sha256, 增量同步用
+
+    previous为上次同步时记录的内容, 据此发条件请求、判断内容是否变化。
+    refresh为True时(琴谱有变化, 需要重新处理)本次还没请求过的url不直接用缓存,
+    先带上次的ETag/Last-Modified发条件请求, 返回304才使用缓存的内容。
+    """
+
+    def __init__(self, previous=None, refresh=False):
+        self.previous = previous or {}
+        self.refresh = refresh
+        self.current = {}
+        self._lock = threading.Lock()
+
+    def record(self, url, digest, headers=None):
+        item = {'sha256': digest}
+        if headers is not None:
+            if headers.get('ETag'):
+                item['etag'] = headers['ETag']
+            if headers.get('Last-Modified'):
+                item['last_modified'] = headers['Last-Modified']
+        with self._lock:
+            if headers is None:
+                # 来自本地缓存, 内容没变时沿用本次或上次记录的校验信息
+                for old in (self.current.get(url), self.previous.get(url)):
+                    if old and old.get('sha256') == digest:
+                        item = dict(old)
+                        break
+            self.current[url] = item
+
+    def keep(self, url):
+        """服务器返回304, 沿用上次的记录"""
+        with self._lock:
+            self.current[url] = dict(self.previous[url])
+
+    def must_revalidate(self, url):
+        """refresh时本次还没请求过的url, 缓存可能已经过时"""
+        return self.refresh and url not in self.current
+
+    def unchanged(self, url):
+        old, new = self.previous.get(url), self.current.get(url)
+        return bool(old and new and old['sha256'] == new['sha256'])
+
+    def conditional_headers(self, url):
+        old = self.previous.get(url) or {}
+        headers = {}
+        if old.get('etag'):
+            headers['If-None-Match'] = old['etag']
+        if old.get('last_modified'):
+            headers['If-Modified-Since'] = old['last_modified']
+        return headers
+
+_sources = contextvars.ContextVar('sources', default=None)
+
+def current_sources():
+    """当前正在记录的Sources, 不在增量同步中时为None"""
+    return _sources.get()
+
+@contextmanager
+def track_sources(sources):
+    """在with块内的请求都记录到sources"""
+    token = _sources.set(sources)
+    try:
+        yield sources
+    finally:
+        _sources.reset(token)
+
+class Transport:
+    """所有网络请求共用的连接池, 带超时、指数退避重试和按主机的限速"""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=3, backoff=0.5,
+                 pool_connections=10, pool_maxsize=16, headers=None, cache=None, limiter=None):
+        self.timeout = timeout
+        self.cache = cache
+        self.limiter = limiter or ratelimit.RateLimiter()
+        self._lock = threading.Lock()
+        self._retries = 0
+        self._retry_errors = 0
+        self._requests = {}
+
+        retry = _CountingRetry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUS,
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            raise_on_status=False,
+            on_retry=self._count_retry,
+        )
+        self._adapter = HTTPAdapter(pool_connections=pool_connections,
+                                    pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+    def _count_retry(self, host, status, error, retry_after=None):
+        metrics.current().add('http.retries')
+        with self._lock:
+            self._retries += 1
+            if error is not None:
+                self._retry_errors += 1
+        if host and (error is not None or status in ratelimit.OVERLOAD_STATUS):
+            self.limiter.penalize(host, status, error is not None, retry_after)
+
+    def _send(self, url, headers=None, stream=False, timeout=None, **kwargs):
+        host = urlsplit(url).netloc
+        with self._lock:
+            self._requests[host] = self._requests.get(host, 0) + 1
+        metrics.current().add('http.requests')
+        return self.session.get(url, headers=headers, stream=stream,
+                                timeout=timeout or self.timeout, **kwargs)
+
+    def get(self, url, headers=None, stream=False, timeout=None, **kwargs):
+        with self.limiter.slot(url) as slot:
+            return slot.done(self._send(url, headers, stream, timeout, **kwargs))
+
+    def fetch(self, url, kind=None, headers=None):
+        """GET并返回响应内容, 指定kind且启用了缓存时先查缓存"""
+        sources = _sources.get()
+        if self.cache is not None and kind:
+            data = self.cache.get(url, kind)
+            if data is not None:
+                if sources is None or not sources.must_revalidate(url):
+                    if sources is not None:
+                        sources.record(url, hashlib.sha256(data).hexdigest())
+                    return data
+                conditional = sources.conditional_headers(url)
+                if conditional:
+                    resp = self.get(url, headers={**(headers or {}), **conditional})
+                    if resp.status_code == 304:
+                        metrics.current().add('http.not_modified')
+                        sources.record(url, hashlib.sha256(data).hexdigest())
+                        return data
+                    return self._store(url, kind, resp, sources)
+        return self._store(url, kind, self.get(url, headers=headers), sources)
+
+    def _store(self, url, kind, resp, sources):
+        resp.raise_for_status()
+        data = resp.content
+        metrics.current().add('http.bytes', len(data))
+        if sources is not None:
+            sources.record(url, hashlib.sha256(data).hexdigest(), resp.headers)
+        if self.cache is not None and kind:
+            self.cache.put(url, kind, data)
+        return data
+
+    def revalidate(self, url, kind=None, headers=None):
+        """带上次记录的ETag/Last-Modified发条件请求, 内容没变(304或sha256相同)时返回None
+
+        需要在track_sources()内调用; 不读缓存, 拿到新内容时更新缓存。
+        """
+        sources = _sources.get()
+        resp = self.get(url, headers={**(headers or {}), **sources.conditional_headers(url)})
+        if resp.status_code == 304 and url in sources.previous:
+            metrics.current().add('http.not_modified')
+            sources.keep(url)
+            return None
+        resp.raise_for_status()
+        data = resp.content
+        metrics.current().add('http.bytes', len(data))
+        sources.record(url, hashlib.sha256(data).hexdigest(), resp.headers)
+        if self.cache is not None and kind:
+            self.cache.put(url, kind, data)
+        return None if sources.unchanged(url) else data
+
+    def iter_content(self, url, kind=None, chunk_size=1 << 16):
+        """分块产出响应内容, 不把整个响应读进内存
+
+        缓存命中时直接读缓存文件; 未命中时边下载边写入缓存, 全部读完才写入。
+        """
+        sources = _sources.get()
+        digest = hashlib.sha256() if sources is not None else None
+        cache = self.cache if kind else None
+        path = cache.get_path(url, kind) if cache is not None else None
+        conditional = None
+        if path is not None and sources is not None and sources.must_revalidate(url):
+            # 缓存可能过时: 有校验信息时发条件请求, 没有就重新下载
+            conditional = sources.conditional_headers(url)
+            if not conditional:
+                path = None
+        if path is not None and not conditional:
+            f = _open_cached(path)
+            if f is not None:
+                yield from _read_cached(f, chunk_size, digest)
+                if digest is not None:
+                    sources.record(url, digest.hexdigest())
+                return
+
+        # 整个下载过程都占用限速的并发名额
+        with self.limiter.slot(url) as slot, slot.done(self._send(url, headers=conditional, stream=True)) as resp:
+            not_modified = bool(conditional) and resp.status_code == 304
+            if not not_modified:
+                resp.raise_for_status()
+                m = metrics.current()
+                with cache.writer(url, kind) if cache is not None else _null_writer() as f:
+                    for chunk in resp.iter_content(chunk_size):
+                        m.add('http.bytes', len(chunk))
+                        if digest is not None:
+                            digest.update(chunk)
+                        if f is not None:
+                            f.write(chunk)
+                        yield chunk
+                if digest is not None:
+                    sources.record(url, digest.hexdigest(), resp.headers)
+        if not not_modified:
+            return
+        metrics.current().add('http.not_modified')
+        f = _open_cached(path)
+        if f is None:
+            # 304之后缓存文件刚好被淘汰, 不带条件重新下载
+            yield from self.iter_content(url, kind=kind, chunk_size=chunk_size)
+            return
+        yield from _read_cached(f, chunk_size, digest)
+        sources.record(url, digest.hexdigest())
+
+    def stats(self):
+        hosts = {}
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = pool.host if pool.port in (None, 80, 443) else f"{pool.host}:{pool.port}"
+            item = hosts.setdefault(host, {'requests': 0, 'connections': 0})
+            item['requests'] += pool.num_requests
+            item['connections'] += pool.num_connections
+        for item in hosts.values():
+            item['reused'] = max(0, item['requests'] - item['connections'])
+        with self._lock:
+            stats = {
+                'requests': sum(self._requests.values()),
+                'retries': self._retries,
+                'retry_errors': self._retry_errors,
+                'hosts': hosts,
+            }
+        stats['limits'] = self.limiter.stats()
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+    def close(self):
+        self.session.close()
+
+@contextmanager
+def _null_writer():
+    yield None
+
+def _open_cached(path):
+    try:
+        return open(path, 'rb')
+    except FileNotFoundError:
+        # 刚好被其它进程淘汰, 改从网络下载
+        return None
+
+def _read_cached(f, chunk_size, digest=None):
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            if digest is not None:
+                digest.update(chunk)
+            yield chunk
+
+_default = None
+_default_lock = threading.Lock()
+
+def get_transport():
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Transport()
+        return _default
+
+def configure(**kwargs):
+    """替换默认Transport, 参数同Transport"""
+    global _default
+    with _default_lock:
+        old, _default = _default, Transport(**kwargs)
+    if old is not None:
+        old.close()
+    return _default
+
+def get(url, headers=None, **kwargs):
+    return get_transport().get(url, headers=headers, **kwargs)
+
+def fetch(url, kind=None, headers=None):
+    return get_transport().fetch(url, kind=kind, headers=headers)
+
+def revalidate(url, kind=None, headers=None):
+    return get_transport().revalidate(url, kind=kind, headers=headers)
+
+def iter_content(url, kind=None, chunk_size=1 << 16):
+    return get_transport().iter_content(url, kind=kind, chunk_size=chunk_size)